@@ -0,0 +1,189 @@
+'''
+This file is used to benchmark the stages of the pipeline on synthetic data, and to compare the results across commits.
+'''
+
+# Import libraries
+import sys
+import os
+import glob
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Pre-processing'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ConflictDetection'))
+import Synthesising
+import Profiling
+
+# Define the directory of the project
+path_synthetic = './localdata/synthetic/'
+path_results = './localdata/benchmarks/'
+
+# Define settings
+repeats = 3 # times each stage is run, the fastest run is reported
+vehnum = 7500 # samples per speed bin, as in Sampling.py
+stages = ['leader search', 'position reconstruction', 'car-following extraction',
+          'determine_conflicts', 'Grouping', 'KDE fitting', 'solve_threshold']
+
+
+# Define functions
+def raw_data():
+    # raw FreewayB data as in preprocess_file before the leader search
+    import FreewayB_preprocessing
+    data = []
+    for data_file in sorted(glob.glob(path_synthetic + 'rawdata/*.csv')):
+        recording = pd.read_csv(data_file, usecols=list(FreewayB_preprocessing.raw_dtypes.keys()), dtype=FreewayB_preprocessing.raw_dtypes)
+        suffix = int(data_file[-6:-4])
+        recording['frameNum'] = suffix*100000 + recording['frameNum']
+        recording['carId'] = suffix*100000 + recording['carId']
+        data.append(recording)
+    data = pd.concat(data).reset_index(drop=True)
+    data['headXft'] = (data.boundingBox1Xft + data.boundingBox4Xft)/2
+    return data.rename(columns={'frameNum':'frame_id','carId':'track_id'})
+
+
+def samples_data():
+    import Sampling
+    Sampling.data_path = path_synthetic
+    files = sorted(glob.glob(path_synthetic + 'outputdata/FreewayB_*'))
+    data = pd.concat([Sampling.load_outputdata(os.path.splitext(os.path.basename(file))[0], Sampling.freewayb_columns) for file in files])
+    return Sampling.freewayb_samples(data.reset_index(drop=True))
+
+
+def bin_data():
+    # the samples of the speed bin with the most conflicts of the first type, and these conflicts
+    import Sampling
+    ctype = Sampling.conflict_rules['ctype'].iloc[0]
+    samples, bins = Sampling.Grouping(Sampling.determine_conflicts(samples_data()), vehnum)
+    roundv = samples.groupby('round_v')[ctype].sum().idxmax()
+    sample = samples[samples['round_v']==roundv]
+    return sample['s'].values, sample[sample[ctype]]['s'].values
+
+
+def prepare_stage(stage):
+    # the inputs of a stage and the call to time
+    if stage == 'leader search':
+        import FreewayB_preprocessing
+        data = raw_data()
+        return len(data), lambda: FreewayB_preprocessing.assign_preceding(data)
+    elif stage == 'position reconstruction':
+        import FreewayB_preprocessing
+        data = raw_data().drop_duplicates(['track_id','frame_id']).rename(columns={'headXft':'x'})
+        data = data.sort_values(['track_id','frame_id']).reset_index(drop=True)
+        return len(data), lambda: FreewayB_preprocessing.reconstruct_position(data)
+    elif stage == 'car-following extraction':
+        import HundredCar_preprocessing
+        path_input = path_synthetic + 'inputdata/100Car/'
+        data_ego = pd.read_hdf(path_input + 'HundredCar_Crash_Ego.h5', key='data')
+        data_sur = pd.read_hdf(path_input + 'HundredCar_Crash_Surrounding.h5', key='data').drop(columns=['x','y'])
+        meta = pd.read_csv(path_input + 'HundredCar_metadata_CrashEvent.csv').set_index('webfileid')
+        meta = meta[meta['target'].isin(['lead vehicle','following vehicle'])]
+        data_ego, data_sur = data_ego[data_ego['trip_id'].isin(meta.index)], data_sur[data_sur['trip_id'].isin(meta.index)]
+        return len(data_sur), lambda: HundredCar_preprocessing.cf_extractor([data_ego, data_sur], meta)
+    elif stage == 'determine_conflicts':
+        import Sampling
+        samples = samples_data()
+        return len(samples), lambda: Sampling.determine_conflicts(samples)
+    elif stage == 'Grouping':
+        import Sampling
+        samples = Sampling.determine_conflicts(samples_data())
+        return len(samples), lambda: Sampling.Grouping(samples, vehnum)
+    elif stage == 'KDE fitting':
+        # fitting and evaluating the density of s on range_s, as for smax in Computing.py
+        import Computing
+        values_s, values_sc = bin_data()
+        return len(values_s), lambda: Computing.fit_kde(values_s)(np.arange(0, 200, 0.1))
+    elif stage == 'solve_threshold':
+        import Computing
+        values_s, values_sc = bin_data()
+        prob_s, prob_sc = Computing.fit_kde(values_s), Computing.fit_kde(values_sc)
+        c = len(values_sc)/len(values_s)
+        return len(values_s), lambda: Computing.solve_threshold(prob_s, prob_sc, values_sc.max(), c)
+    raise ValueError('stage should be one of '+str(stages))
+
+
+def run_stage(stage):
+    num_rows, call = prepare_stage(stage)
+    setup_rss = Profiling.peak_rss()
+    seconds = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - start)
+    return {'stage':stage, 'rows':num_rows, 'seconds':min(seconds), 'rows_per_second':num_rows/min(seconds),
+            'setup_peak_rss_mb':setup_rss, 'peak_rss_mb':Profiling.peak_rss()}
+
+
+def preprocess_synthetic():
+    # preprocessed FreewayB outputdata, the input of the sampling and computing stages
+    import FreewayB_preprocessing
+    FreewayB_preprocessing.path_inputdata = path_synthetic + 'inputdata/FreewayB/'
+    FreewayB_preprocessing.path_outputdata = path_synthetic + 'outputdata/'
+    os.makedirs(FreewayB_preprocessing.path_inputdata, exist_ok=True)
+    os.makedirs(FreewayB_preprocessing.path_outputdata, exist_ok=True)
+    for data_file in sorted(glob.glob(path_synthetic + 'rawdata/*.csv')):
+        FreewayB_preprocessing.preprocess_file(data_file)
+
+
+def git_commit():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git','rev-parse','HEAD'], cwd=directory, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git','status','--porcelain','--untracked-files=no'], cwd=directory, capture_output=True, text=True).stdout.strip() != ''
+    except OSError:
+        return None, None
+    return (commit if commit != '' else None), dirty
+
+
+def run_benchmark():
+    # each stage runs in a fresh process, so that its peak RSS is not shared with the other stages
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for stage in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(run_stage, stage).result())
+        print(stage + ': ' + str(round(results[-1]['seconds'], 4)) + ' s, ' + str(round(results[-1]['peak_rss_mb'])) + ' MB')
+
+    commit, dirty = git_commit()
+    return {'commit':commit, 'dirty':dirty, 'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform':platform.platform(), 'python':platform.python_version(), 'cpu_count':os.cpu_count(),
+            'numpy':np.__version__, 'pandas':pd.__version__, 'scipy':scipy.__version__,
+            'settings':{'num_files':Synthesising.num_files, 'num_frames':Synthesising.num_frames, 'num_vehicles':Synthesising.num_vehicles,
+                        'num_trips':Synthesising.num_trips, 'seed':Synthesising.seed, 'repeats':repeats, 'vehnum':vehnum},
+            'stages':results}
+
+
+def compare(result_before, result_after):
+    # speedup of each stage between two saved results
+    before = pd.DataFrame(result_before['stages']).set_index('stage')
+    after = pd.DataFrame(result_after['stages']).set_index('stage')
+    comparison = pd.DataFrame({'seconds_before':before['seconds'], 'seconds_after':after['seconds'],
+                               'peak_rss_mb_before':before['peak_rss_mb'], 'peak_rss_mb_after':after['peak_rss_mb']}).dropna()
+    comparison['speedup'] = comparison['seconds_before']/comparison['seconds_after']
+    return comparison
+
+
+if __name__ == '__main__':
+    print('Generating synthetic data...')
+    Synthesising.generate_citysim(path_synthetic + 'rawdata/')
+    Synthesising.generate_hundredcar(path_synthetic + 'inputdata/100Car/')
+    preprocess_synthetic()
+
+    print('Benchmarking...')
+    result = run_benchmark()
+    os.makedirs(path_results, exist_ok=True)
+    previous = sorted(glob.glob(path_results + 'benchmark_*.json'))
+    path = path_results + 'benchmark_' + time.strftime('%Y%m%d-%H%M%S') + '_' + str(result['commit'])[:7] + '.json'
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+    print('Results saved in ' + path)
+
+    if len(previous) > 0:
+        with open(previous[-1]) as file:
+            print('Compared with ' + previous[-1] + ':')
+            print(compare(json.load(file), result).to_string())
@@ -0,0 +1,127 @@
+'''
+This file is used to generate synthetic data shaped as the CitySim FreewayB and 100Car NDS data, to run and benchmark the pipeline without access to them.
+'''
+
+# Import libraries
+import os
+import numpy as np
+import pandas as pd
+
+# Define the directory of the project
+path_synthetic = './localdata/synthetic/'
+
+# Define settings
+num_files = 2 # FreewayB recordings
+num_frames = 9000 # frames per recording, at 30 fps
+num_vehicles = 200 # vehicles per lane and recording
+road_length = 1000. # ft, length of the recorded road section
+num_trips = 200 # 100Car trips per event type
+seed = 0
+
+
+# Define functions
+def stop_and_go(rng, num_steps, step, mean_speed, amplitude):
+    # a smooth speed profile as a sum of waves with random periods and phases, not below 0
+    time = np.arange(num_steps)*step
+    speed = np.full(num_steps, mean_speed)
+    for period in rng.uniform(8, 60, 4):
+        speed += amplitude/4*np.sin(2*np.pi*time/period + rng.uniform(0, 2*np.pi))
+    return np.clip(speed, 0, None)
+
+
+def citysim_recording(rng, num_frames, num_vehicles):
+    # in each lane, vehicles repeat the trajectory of their leader with a delay and a spacing shift (Newell's car-following),
+    # lanes 1-2 drive towards decreasing x and lanes 3-4 towards increasing x, as in FreewayB
+    recording = []
+    for lane in range(1, 5):
+        delays = rng.integers(20, 60, num_vehicles) # frames
+        shifts = rng.uniform(22, 50, num_vehicles) # ft, longer than the vehicles
+        delays[0], shifts[0] = 0, 0.
+        cum_delays, cum_shifts = np.cumsum(delays), np.cumsum(shifts)
+        num_steps = num_frames + cum_delays[-1]
+        speed = stop_and_go(rng, num_steps, 1/30, rng.uniform(25, 45), 40) # mph
+        position = np.cumsum(speed*5280/3600/30) - cum_shifts[-1]*rng.uniform(0, 1) # ft, of the first vehicle
+        lengths = rng.uniform(13, 19, num_vehicles)
+
+        frames = np.arange(num_frames)
+        for vehicle in range(num_vehicles):
+            steps = frames + cum_delays[-1] - cum_delays[vehicle]
+            head = position[steps] - cum_shifts[vehicle]
+            observed = (head>=0)&(head<=road_length)
+            if not observed.any():
+                continue
+            head, tail = head[observed], head[observed] - lengths[vehicle]
+            if lane < 2.5:
+                head, tail = road_length - head, road_length - tail
+            y = lane*12. + rng.normal(0, 0.3)
+            noise = rng.normal(0, 0.1, (8, observed.sum()))
+            recording.append(pd.DataFrame({'frameNum':frames[observed], 'carId':lane*1000+vehicle,
+                                           'speed':speed[steps[observed]] + rng.normal(0, 0.2, observed.sum()), 'laneId':lane,
+                                           'boundingBox1Xft':head+noise[0], 'boundingBox1Yft':y+3+noise[1],
+                                           'boundingBox2Xft':tail+noise[2], 'boundingBox2Yft':y+3+noise[3],
+                                           'boundingBox3Xft':tail+noise[4], 'boundingBox3Yft':y-3+noise[5],
+                                           'boundingBox4Xft':head+noise[6], 'boundingBox4Yft':y-3+noise[7]}))
+    return pd.concat(recording).sort_values(['frameNum','carId']).reset_index(drop=True)
+
+
+def generate_citysim(path, num_files=num_files, num_frames=num_frames, num_vehicles=num_vehicles, seed=seed):
+    # raw csv files named as FreewayB-01.csv, FreewayB-02.csv, ...
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for suffix in range(1, num_files+1):
+        recording = citysim_recording(rng, num_frames, num_vehicles)
+        recording.to_csv(path + 'FreewayB-' + str(suffix).zfill(2) + '.csv', index=False)
+
+
+def hundredcar_trip(rng, trip_id, target):
+    # an ego vehicle at 10 Hz with the target it follows or is followed by, and other targets in the opposite direction
+    num_steps = rng.integers(100, 400)
+    time = np.round(np.arange(num_steps)*0.1, 1)
+    speed = stop_and_go(rng, num_steps, 0.1, rng.uniform(5, 20), 10)
+    x = np.cumsum(speed*0.1)
+    ego = pd.DataFrame({'trip_id':trip_id, 'time':time, 'x_ekf':x, 'y_ekf':rng.normal(0, 0.1, num_steps),
+                        'psi_ekf':0., 'v_ekf':speed})
+
+    forward = target == 'lead vehicle'
+    surrounding = []
+    for target_id in range(rng.integers(1, 4)):
+        # the first target is the one in car-following
+        direction = forward if target_id == 0 else not forward
+        observed = rng.uniform(size=num_steps) < 0.9
+        spacing = np.clip(stop_and_go(rng, num_steps, 0.1, rng.uniform(10, 30), 15), 1, None)
+        speed_target = speed + np.gradient(spacing, 0.1)*(1 if direction else -1)
+        x_target = x + spacing*(1 if direction else -1)
+        y_target = rng.normal(0, 0.2, num_steps)
+        surrounding.append(pd.DataFrame({'trip_id':trip_id, 'time':time, 'target_id':target_id, 'x':x_target, 'y':y_target,
+                                         'x_ekf':x_target, 'y_ekf':y_target, 'psi_ekf':0., 'v_ekf':speed_target,
+                                         'range':np.round(spacing, 2), 'forward':int(direction)})[observed])
+    surrounding = pd.concat(surrounding).sort_values(['time','target_id'])
+
+    # events around the closest approach to the target in car-following
+    closest = surrounding[surrounding['target_id']==0]['range'].idxmin() if (surrounding['target_id']==0).any() else 0
+    ego['event'] = (np.abs(np.arange(num_steps)-closest) < rng.integers(5, 30)).astype(int)
+    return ego, surrounding
+
+
+def generate_hundredcar(path, num_trips=num_trips, seed=seed):
+    # ego and surrounding hdf files and metadata as in inputdata/100Car, for crashes and near-crashes
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for event_id, conflict_type in enumerate(['Crash', 'NearCrash']):
+        data_ego, data_sur, meta = [], [], []
+        for trip in range(num_trips):
+            trip_id = event_id*100000 + trip
+            target = rng.choice(['lead vehicle','following vehicle','Single vehicle conflict'], p=[0.6,0.3,0.1])
+            ego, surrounding = hundredcar_trip(rng, trip_id, target)
+            data_ego.append(ego)
+            data_sur.append(surrounding)
+            meta.append([trip_id, conflict_type, target])
+        pd.concat(data_ego).reset_index(drop=True).to_hdf(path + 'HundredCar_'+conflict_type+'_Ego.h5', key='data', mode='w')
+        pd.concat(data_sur).reset_index(drop=True).to_hdf(path + 'HundredCar_'+conflict_type+'_Surrounding.h5', key='data', mode='w')
+        pd.DataFrame(meta, columns=['webfileid','event severity','target']).to_csv(path + 'HundredCar_metadata_'+conflict_type+'Event.csv', index=False)
+
+
+if __name__ == '__main__':
+    generate_citysim(path_synthetic + 'rawdata/')
+    generate_hundredcar(path_synthetic + 'inputdata/100Car/')
+    print('Synthetic data saved in '+path_synthetic)
@@ -0,0 +1,81 @@
+'''
+This file is used to cache fitted densities and pma/pfa curves on disk, so that later runs can reuse them.
+'''
+
+# Import libraries
+import os
+import hashlib
+import numpy as np
+
+# Define settings
+cache_version = 1 # part of every key, to be increased whenever the cached densities or curves change for the same inputs and settings
+evict_fraction = 0.9 # eviction removes entries down to this share of cache_size, so that a full cache is not scanned at every save
+
+# Size of each cache directory as seen by this process: scanned at its first save, then increased by the entries it saves
+cache_totals = {} # cache_dir -> bytes
+
+
+# Define functions
+def cache_key(kind, arrays, **settings):
+    # entries are addressed by their content: the sample arrays, the scalars and the density settings they are computed from,
+    # and by the version of the code computing them
+    key = hashlib.sha256(kind.encode())
+    key.update(str(cache_version).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        key.update(str(array.shape).encode())
+        key.update(array.tobytes())
+    key.update(repr(sorted(settings.items())).encode())
+    return kind + '_' + key.hexdigest()
+
+
+def load_cache(cache_dir, key):
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(path) as entry:
+            arrays = {name:entry[name] for name in entry.files}
+        # the modification time records the last use for least recently used eviction
+        os.utime(path)
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+    return arrays
+
+
+def save_cache(cache_dir, key, cache_size, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.npz')
+    # write to a temporary file first, so that concurrent workers never read a partial entry
+    temporary = os.path.join(cache_dir, key + '.' + str(os.getpid()) + '.tmp.npz')
+    np.savez(temporary, **arrays)
+    size = os.path.getsize(temporary)
+    os.replace(temporary, path)
+    # the directory is only scanned again when the total exceeds cache_size; entries saved by other processes
+    # are not counted until then, which the final evict_cache of a run makes up for
+    if cache_dir in cache_totals:
+        cache_totals[cache_dir] += size
+    if cache_totals.get(cache_dir, np.inf) > cache_size:
+        evict_cache(cache_dir, cache_size)
+
+
+def evict_cache(cache_dir, cache_size):
+    # least recently used entries are removed until the cache is within evict_fraction of cache_size
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total_size = sum([entry[1] for entry in entries])
+    if total_size > cache_size:
+        for mtime, size, name in sorted(entries):
+            if total_size <= evict_fraction*cache_size:
+                break
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+    cache_totals[cache_dir] = total_size
+    return total_size
@@ -10,10 +10,36 @@ import pandas as pd
 import numpy as np
 from scipy import optimize
 from scipy import stats
+from scipy import special
+from scipy import signal
+from concurrent.futures import ProcessPoolExecutor
+import Caching
+import Profiling
+import Storing
 
 # Define the directory of the project
 data_path = './localdata/'
 
+# Define settings
+kde_backend = 'scipy' # 'scipy' for exact gaussian_kde, 'binned' for linear binning and FFT convolution in large bins
+bw_method = 'scott' # 'scott' or 'silverman', as in scipy
+binned_min_samples = 2000 # bins with fewer samples are always fitted with gaussian_kde
+grid_step = 0.05 # spacing (m) of the grid used by binned_kde
+binned_accuracy_report = False # with the 'binned' backend, also compare the binned and exact densities of the binned bins
+num_workers = 1 # processes solving (conflict type, round_v) jobs in parallel, 1 to run serially
+use_cache = True # reuse densities and pma/pfa curves of bins solved in earlier runs
+cache_dir = data_path + 'cache/'
+cache_size = 2*1024**3 # bytes, least recently used entries are removed beyond this
+sweep_alphas = np.linspace(0., 1., 1001) # alphas of the dense sweep saved with the Pareto frontiers
+threshold_solver = 'grid' # 'grid' to search thresholds on a 0.1 m grid, 'exact' to refine the minimum of a coarse grid by root finding
+coarse_step = 1. # spacing (m) of the coarse grid bracketing the minima in the 'exact' solver
+solver_tolerance = 1e-3 # m, precision of the thresholds and of the mode of s in the 'exact' solver
+bootstrap_replicates = 0 # resamples of each (conflict type, round_v) bin for percentile intervals of the thresholds, 0 to skip
+bootstrap_batch = 20 # replicates per job, jobs run in parallel with num_workers
+bootstrap_level = 0.95 # coverage of the percentile intervals
+bootstrap_seed = 0
+use_store = True # read the samples of each bin as a slice of the memory-mapped store of Storing.py, instead of scanning samples_toinfer
+
 
 # Define functions
 def round_speed(samples, roundvs):
@@ -39,139 +65,550 @@ def load_data(loc):
     samples = pd.read_hdf(data_path + '/samples/samples_'+loc+'.h5', key='data')
     samples = samples.reset_index(drop=True)
     samples_toinfer = pd.read_hdf(data_path + '/samples/samples_toinfer_'+loc+'.h5', key='samples')
-    roundvs = samples_toinfer['round_v'].unique()
+    roundvs = np.sort(samples_toinfer['round_v'].unique())
     samples = round_speed(samples, roundvs)
     return samples, samples_toinfer, roundvs
 
 
-def spacing_inference_s(samples_toinfer, roundvs, loc):
-    prob_s = {key:[] for key in roundvs}
+def load_store(loc):
+    # the store is written by Sampling.py, or here from samples_toinfer when it is missing or older
+    path = Storing.store_path(loc)
+    source = data_path + 'samples/samples_toinfer_'+loc+'.h5'
+    if Storing.is_stale(path, source):
+        Storing.write_store(pd.read_hdf(source, key='samples'), path)
+    return Storing.open_store(path)
+
+
+def bin_samples(samples_toinfer, roundv, columns):
+    # the values of columns in the bin of roundv, sliced from a store or filtered from samples_toinfer
+    if isinstance(samples_toinfer, Storing.sample_store):
+        return [samples_toinfer.bin(roundv, column) for column in columns]
+    sample = samples_toinfer[samples_toinfer['round_v']==roundv]
+    return [sample[column].values for column in columns]
+
+
+def linear_binning(values, grid_start, grid_step, grid_size, weights=None):
+    # each value (or its weight) is shared between its two neighbouring grid points in proportion to its distance to them
+    position = (values - grid_start)/grid_step
+    left = np.floor(position).astype(int)
+    fraction = position - left
+    weights = 1. if weights is None else weights
+    counts = np.bincount(left, weights=(1-fraction)*weights, minlength=grid_size+1)
+    counts += np.bincount(left+1, weights=fraction*weights, minlength=grid_size+1)
+    return counts[:grid_size]
+
+
+class binned_kde():
+    # fitted to a dataset, or to the counts of a dataset linearly binned on a grid together with its size and variance
+    def __init__(self, dataset=None, bw_method='scott', grid_step=0.05, counts=None, grid=None, n=None, variance=None):
+        super().__init__()
+        if dataset is not None:
+            dataset = np.asarray(dataset, dtype=float).ravel()
+            n, variance = len(dataset), np.var(dataset, ddof=1)
+        self.n = n
+        if bw_method == 'scott':
+            self.factor = self.n**(-1./5)
+        elif bw_method == 'silverman':
+            self.factor = (self.n*3/4.)**(-1./5)
+        else:
+            self.factor = float(bw_method)
+        self.covariance = np.array([[variance*self.factor**2]])
+        self.bandwidth = np.sqrt(self.covariance[0,0])
+        self.grid_step = grid_step
+        if dataset is not None:
+            start = np.floor((dataset.min()-8.5*self.bandwidth)/self.grid_step)
+            end = np.ceil((dataset.max()+8.5*self.bandwidth)/self.grid_step)
+            grid = np.arange(start, end+1)*self.grid_step
+            counts = linear_binning(dataset, grid[0], self.grid_step, len(grid))
+        self.grid = grid
+        self.counts = counts/self.n
+        self.pdf_grid, self.cdf_grid = self.convolve(self.counts)
+        self.derivative_grid = None
+
+
+    # Convolution of the binned counts with the gaussian pdf and cdf
+    def convolve(self, counts):
+        offsets = np.arange(-len(self.grid)+1, len(self.grid))*self.grid_step/self.bandwidth
+        pdf_grid = signal.fftconvolve(counts, stats.norm.pdf(offsets)/self.bandwidth)[len(self.grid)-1:2*len(self.grid)-1]
+        cdf_grid = signal.fftconvolve(counts, special.ndtr(offsets))[len(self.grid)-1:2*len(self.grid)-1]
+        return np.clip(pdf_grid, 0, None), np.clip(cdf_grid, 0, 1)
+
+
+    def evaluate(self, points):
+        return np.interp(np.atleast_1d(points), self.grid, self.pdf_grid, left=0., right=0.)
+
+    __call__ = evaluate
+
+
+    def cdf(self, points):
+        return np.interp(np.atleast_1d(points), self.grid, self.cdf_grid, left=0., right=1.)
+
+
+    def integrate_box_1d(self, low, high):
+        return self.cdf(high)[0] - self.cdf(low)[0]
+
+
+    def derivative(self, points):
+        if self.derivative_grid is None:
+            offsets = np.arange(-len(self.grid)+1, len(self.grid))*self.grid_step/self.bandwidth
+            kernel = -offsets*stats.norm.pdf(offsets)/self.bandwidth**2
+            self.derivative_grid = signal.fftconvolve(self.counts, kernel)[len(self.grid)-1:2*len(self.grid)-1]
+        return np.interp(np.atleast_1d(points), self.grid, self.derivative_grid, left=0., right=0.)
+
+
+def fit_kde(values):
+    Profiling.count('kde_fits')
+    if kde_backend == 'binned' and len(values) >= binned_min_samples:
+        return binned_kde(values, bw_method=bw_method, grid_step=grid_step)
+    else:
+        return stats.gaussian_kde(values, bw_method=bw_method)
+
+
+def binned_accuracy(samples_toinfer, roundvs, loc, conflict_type=None):
+    range_s = np.arange(0, 200, 0.1)
+    report = []
+    for roundv in tqdm(roundvs, desc=loc):
+        if conflict_type is None:
+            values = bin_samples(samples_toinfer, roundv, ['s'])[0]
+        else:
+            values, conflict = bin_samples(samples_toinfer, roundv, ['s', conflict_type])
+            values = values[conflict]
+        # only bins that fit_kde fits with binned_kde
+        if len(values) < binned_min_samples:
+            continue
+        kde_exact = stats.gaussian_kde(values, bw_method=bw_method)
+        kde_binned = binned_kde(values, bw_method=bw_method, grid_step=grid_step)
+        pdf_error = np.abs(kde_exact(range_s) - kde_binned(range_s)).max()
+        cdf_error = np.abs(kde_cdf(kde_exact, range_s) - kde_binned.cdf(range_s)).max()
+        report.append([roundv, len(values), kde_binned.bandwidth, len(kde_binned.grid), pdf_error, cdf_error])
+    report = pd.DataFrame(report, columns=['round_v','num_samples','bandwidth','grid_size','max_pdf_error','max_cdf_error'])
+    report['ctype'] = 'all' if conflict_type is None else conflict_type
+    return report
+
+
+def spacing_samples_s(samples_toinfer, roundvs):
+    values_s = {}
     len_s_list = []
 
-    for i in tqdm(range(len(roundvs)), desc=loc):
-        roundv = roundvs[i]
+    for roundv in roundvs:
+        values_s[roundv] = bin_samples(samples_toinfer, roundv, ['s'])[0]
+        len_s_list.append(len(values_s[roundv]))
 
-        sample = samples_toinfer[samples_toinfer['round_v']==roundv]
-        kde_s = stats.gaussian_kde(sample['s'].values)
-        prob_s[roundv] = kde_s
-        len_s_list.append(len(sample))
-        
     len_s_list = np.array(len_s_list)
-        
-    return prob_s, len_s_list
-    
-    
-def spacing_inference_sc(samples_toinfer, roundvs, loc, conflict_type):
-    prob_sc = {key:[] for key in roundvs}
+
+    return values_s, len_s_list
+
+
+def spacing_samples_sc(samples_toinfer, roundvs, conflict_type):
+    values_sc = {}
     smax_list, c_list, idx_empty = [], [], []
 
-    for i in tqdm(range(len(roundvs)), desc=loc):
+    for i in range(len(roundvs)):
         roundv = roundvs[i]
-        
-        sample = samples_toinfer[(samples_toinfer['round_v']==roundv)&(samples_toinfer[conflict_type])]
-        if len(sample) <= 5:
+
+        values, conflict = bin_samples(samples_toinfer, roundv, ['s', conflict_type])
+        values = values[conflict]
+        if len(values) <= 5:
             idx_empty.append(i)
             smax_list.append(0)
             c_list.append(np.nan)
         else:
-            kde_sc = stats.gaussian_kde(sample['s'].values)
-            prob_sc[roundv] = kde_sc
-            smax_list.append(sample['s'].max())
-            c_list.append(len(sample))
+            values_sc[roundv] = values
+            smax_list.append(values.max())
+            c_list.append(len(values))
 
+    # bins with too few conflicts borrow the samples of the nearest bin with enough
     idx_empty = np.array(idx_empty)
+    Profiling.count('bins_filled', len(idx_empty))
     idx_unempty = np.setdiff1d(np.arange(len(roundvs)), idx_empty)
     for idx in idx_empty:
         fillin_idx = idx_unempty[np.argmin(np.abs(idx_unempty-idx))]
-        prob_sc[roundvs[idx]] = prob_sc[roundvs[fillin_idx]]
+        values_sc[roundvs[idx]] = values_sc[roundvs[fillin_idx]]
 
     c_list = np.array(c_list)
     c_list[np.isnan(c_list)] = np.nanmin(c_list)
 
-    return prob_sc, smax_list, c_list
-
-
-def solve_threshold(prob_s, prob_sc, smax, c):
-    range_s = np.arange(0, 200, 0.1)
-    density_s = prob_s(range_s)
-    smax = max(smax, range_s[np.argmax(density_s)])
+    return values_sc, smax_list, c_list
+
+
+def kde_cdf(kde, points, chunk_size=2**20):
+    # cumulative probability of a 1-D gaussian_kde as a weighted sum of normal cdfs at the samples,
+    # samples beyond 8.5 bandwidths of a point add their full weight or nothing, so points are evaluated
+    # in chunks spanning at most 17 bandwidths and at most chunk_size (point, sample) pairs
+    Profiling.count('cdf_evaluations')
+    if isinstance(kde, binned_kde):
+        return kde.cdf(points)
+    points = np.atleast_1d(points).astype(float)
+    order = np.argsort(kde.dataset[0])
+    dataset = kde.dataset[0][order]
+    weights = kde.weights[order]
+    cum_weights = np.concatenate(([0.], np.cumsum(weights)))
+    stdev = np.sqrt(kde.covariance[0,0])
+    point_order = np.argsort(points)
+    sorted_points = points[point_order]
+    cdf = np.empty(len(points))
+    step = max(1, chunk_size//len(dataset))
+    start = 0
+    while start < len(points):
+        end = min(start+step, np.searchsorted(sorted_points, sorted_points[start]+17*stdev, side='right'))
+        chunk = sorted_points[start:end]
+        lower = np.searchsorted(dataset, chunk[0]-8.5*stdev)
+        upper = np.searchsorted(dataset, chunk[-1]+8.5*stdev)
+        normalized = (chunk[:,np.newaxis] - dataset[lower:upper]) / stdev
+        cdf[point_order[start:end]] = cum_weights[lower] + special.ndtr(normalized) @ weights[lower:upper]
+        start = end
+    return cdf
+
+
+def kde_derivative(kde, points, chunk_size=2**20):
+    # derivative of the density, a weighted sum of normal pdf derivatives at the samples
+    if isinstance(kde, binned_kde):
+        return kde.derivative(points)
+    points = np.atleast_1d(points).astype(float)
+    stdev = np.sqrt(kde.covariance[0,0])
+    derivative = np.empty(len(points))
+    step = max(1, chunk_size//kde.n)
+    for start in range(0, len(points), step):
+        normalized = (points[start:start+step,np.newaxis] - kde.dataset[0]) / stdev
+        derivative[start:start+step] = (-normalized*stats.norm.pdf(normalized)) @ kde.weights / stdev**2
+    return derivative
+
+
+def find_roots(function, points, slopes, sign):
+    # roots between neighbouring points where the slopes change sign from -sign to sign
+    brackets = np.flatnonzero((sign*slopes[:-1]<0)&(sign*slopes[1:]>0))
+    return np.array([optimize.brentq(function, points[j], points[j+1], xtol=solver_tolerance) for j in brackets])
+
+
+def kde_mode(kde, upper=200.):
+    # local maxima are bracketed on a coarse grid by sign changes of the derivative, then refined by brentq
+    range_s = np.arange(0, upper, coarse_step)
+    roots = find_roots(lambda s: kde_derivative(kde, s)[0], range_s, kde_derivative(kde, range_s), -1)
+    candidates = np.concatenate((roots, range_s[[0,-1]]))
+    return candidates[np.argmax(kde(candidates))]
+
+
+def solve_curves(prob_s, prob_sc, smax, c, density_s=None):
+    if threshold_solver == 'exact':
+        smax = max(smax, kde_mode(prob_s))
+    else:
+        range_s = np.arange(0, 200, 0.1)
+        if density_s is None:
+            density_s = prob_s(range_s)
+        smax = max(smax, range_s[np.argmax(density_s)])
+    # the curves, sweep and frontiers are on the 0.1 m grid with either solver
+    range_sc = np.arange(0, smax, 0.1)
 
     cum_smax_s = prob_s.integrate_box_1d(0, smax)
     cum_smax_sc = prob_sc.integrate_box_1d(0, smax)
+    Profiling.count('cdf_evaluations', 2)
+
+    cdf_s = kde_cdf(prob_s, range_sc)
+    cdf_sc = kde_cdf(prob_sc, np.append(range_sc, smax))
+    pma = cdf_sc[-1] - cdf_sc[:-1]
+    pfa = ((cdf_s-cdf_s[0])-c*(cdf_sc[:-1]-cdf_sc[0]))/(cum_smax_s-c*cum_smax_sc)
+
+    return range_sc, pma, pfa, smax, cum_smax_s, cum_smax_sc
+
+
+def refine_thresholds(prob_s, prob_sc, range_sc, pma, pfa, smax, cum_smax_s, cum_smax_sc, c, alphas):
+    # the derivative of alpha*pma + (1-alpha)*pfa with respect to the threshold s is
+    # -alpha*f_sc(s) + (1-alpha)*(f_s(s) - c*f_sc(s))/(cum_smax_s - c*cum_smax_sc);
+    # local minima are bracketed on a coarse grid up to smax and compared with the ends 0 and smax
+    denominator = cum_smax_s - c*cum_smax_sc
+    points = np.append(np.arange(0, smax, coarse_step), smax)
+    density_s, density_sc = prob_s(points), prob_sc(points)
+    alphas = np.asarray(alphas, dtype=float)
+    slopes = -alphas[:,np.newaxis]*density_sc + (1-alphas[:,np.newaxis])*(density_s - c*density_sc)/denominator
+
+    roots, owners = [], []
+    for i, alpha in enumerate(alphas):
+        derivative = lambda s: -alpha*prob_sc(s)[0] + (1-alpha)*(prob_s(s)[0] - c*prob_sc(s)[0])/denominator
+        roots_alpha = find_roots(derivative, points, slopes[i], 1)
+        roots.extend(roots_alpha)
+        owners.extend([i]*len(roots_alpha))
+    roots, owners = np.array(roots), np.array(owners, dtype=int)
+
+    # pma is 0 and pfa is 1 at smax
+    thresholds = np.where(alphas*pma[0] <= 1-alphas, 0., smax)
+    objective = np.minimum(alphas*pma[0], 1-alphas)
+    if len(roots) > 0:
+        cdf_s, cdf_sc = kde_cdf(prob_s, np.append(0., roots)), kde_cdf(prob_sc, np.append(0., roots))
+        objective_roots = alphas[owners]*(pma[0]-(cdf_sc[1:]-cdf_sc[0])) + (1-alphas[owners])*((cdf_s[1:]-cdf_s[0])-c*(cdf_sc[1:]-cdf_sc[0]))/denominator
+        for root, i, value in zip(roots, owners, objective_roots):
+            if value < objective[i]:
+                thresholds[i], objective[i] = root, value
+    return thresholds
 
-    range_sc = np.arange(0, smax, 0.1)
-    pma, pfa = [], []
-    for i in range(len(range_sc)):
-        pma0 = prob_sc.integrate_box_1d(range_sc[i], smax)
-        pma.append(pma0)
-        pfa0 = (prob_s.integrate_box_1d(0, range_sc[i])-c*prob_sc.integrate_box_1d(0, range_sc[i]))/(cum_smax_s-c*cum_smax_sc)
-        pfa.append(pfa0)
-    pma = np.array(pma)
-    pfa = np.array(pfa)
 
+def sweep_thresholds(range_sc, pma, pfa, alphas):
+    # thresholds minimising alpha*pma + (1-alpha)*pfa for all alphas at once, one row of the objective per alpha
+    alphas = np.asarray(alphas, dtype=float)[:,np.newaxis]
+    idx = np.argmin(alphas*pma + (1-alphas)*pfa, axis=1)
+    return range_sc[idx], pma[idx], pfa[idx]
+
+
+def pareto_frontier(range_sc, pma, pfa):
+    # thresholds not dominated in both pma and pfa by another threshold, in increasing order
+    order = np.lexsort((pfa, pma))
+    pfa_sorted = pfa[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = pfa_sorted[1:] < np.minimum.accumulate(pfa_sorted)[:-1]
+    idx = np.sort(order[keep])
+    return range_sc[idx], pma[idx], pfa[idx]
+
+
+def curves_to_thresholds(range_sc, pma, pfa, smax, cum_smax_s, cum_smax_sc, c, refined=None):
     thresholds = np.zeros((19,6))
     alpha_list = np.arange(0.05,1.,0.05)
-    for i in range(19):
-        alpha = alpha_list[i]
-        threshold = range_sc[np.argmin(alpha*pma + (1-alpha)*pfa)]
-        thresholds[i,:] = [alpha, threshold, smax, cum_smax_s, cum_smax_sc, c]
+    thresholds[:,0] = alpha_list
+    if refined is None:
+        thresholds[:,1] = sweep_thresholds(range_sc, pma, pfa, alpha_list)[0]
+    else:
+        thresholds[:,1] = refined
+    thresholds[:,2:] = [smax, cum_smax_s, cum_smax_sc, c]
 
     return thresholds
 
 
-def compute_thresholds(roundvs, prob_s, prob_sc, smax_list, c_list, loc):
-    parameters = pd.DataFrame(np.zeros((len(roundvs)*19, 7)), columns=['round_v','alpha','threshold','smax','cum_smax_s','cum_smax_sc','c'])
-    parameters['round_v'] = np.repeat(roundvs, 19)
-    parameters = parameters.set_index('round_v')
-    
-    for roundv, smax, c in tqdm(zip(roundvs, smax_list, c_list), desc=loc, total=len(roundvs)):
-        prob_s_rv = prob_s[roundv]
-        prob_sc_rv = prob_sc[roundv]
-        thresholds = solve_threshold(prob_s_rv, prob_sc_rv, smax, c)
-        parameters.loc[roundv, ['alpha','threshold','smax','cum_smax_s','cum_smax_sc','c']] = thresholds
-
-    return parameters.reset_index()
-
-
-# Freeway B
-## Load data
-print('Loading FreewayB data...')
-samples_FreewayB, samples_toinfer_FreewayB, roundvs_FreewayB = load_data('FreewayB')
-
-## Create dictionaries for spacing inference
-print('Inferencing spacing...')
-prob_s_FreewayB, len_s = spacing_inference_s(samples_toinfer_FreewayB, roundvs_FreewayB, 'FreewayB')
-prob_sc1_FreewayB, smax_c1_FreewayB, c1_FreewayB = spacing_inference_sc(samples_toinfer_FreewayB, roundvs_FreewayB, 'FreewayB', 'conflict_1')
-prob_sc2_FreewayB, smax_c2_FreewayB, c2_FreewayB = spacing_inference_sc(samples_toinfer_FreewayB, roundvs_FreewayB, 'FreewayB', 'conflict_2')
-prob_sc3_FreewayB, smax_c3_FreewayB, c3_FreewayB = spacing_inference_sc(samples_toinfer_FreewayB, roundvs_FreewayB, 'FreewayB', 'conflict_3')
-c1_FreewayB, c2_FreewayB, c3_FreewayB = c1_FreewayB/len_s, c2_FreewayB/len_s, c3_FreewayB/len_s
-
-## Compute pma and pfa
-print('Computing thresholds...')
-parameters_FreewayB = []
-ctype_list = ['conflict_1', 'conflict_2','conflict_3']
-prob_sc_list = [prob_sc1_FreewayB, prob_sc2_FreewayB, prob_sc3_FreewayB]
-smax_c_list = [smax_c1_FreewayB, smax_c2_FreewayB, smax_c3_FreewayB]
-c_list = [c1_FreewayB, c2_FreewayB, c3_FreewayB]
-for ctype, prob_sc, smax_c, c in zip(ctype_list, prob_sc_list, smax_c_list, c_list):
-    parameters = compute_thresholds(roundvs_FreewayB, prob_s_FreewayB, prob_sc, smax_c, c, 'FreewayB')
-    parameters['ctype'] = ctype
-    parameters_FreewayB.append(parameters)
-parameters_FreewayB = pd.concat(parameters_FreewayB).reset_index(drop=True)
-parameters_FreewayB.to_csv(data_path + 'spacing/parameters_FreewayB.csv', index=False)
-
-
-# 100Car
-## Load data
-samples_100Car, samples_toinfer_100Car, roundvs_100Car = load_data('100Car')
-
-## Create dictionaries for spacing inference
-print('Inferencing spacing...')
-prob_s_100Car, len_s = spacing_inference_s(samples_toinfer_100Car, roundvs_100Car, '100Car')
-prob_sc_100Car, smax_c_100Car, c_100Car = spacing_inference_sc(samples_toinfer_100Car, roundvs_100Car, '100Car', 'conflict')
-c_100Car = c_100Car/len_s
-
-## Compute pma and pfa
-print('Computing thresholds...')
-parameters_100Car = compute_thresholds(roundvs_100Car, prob_s_100Car, prob_sc_100Car, smax_c_100Car, c_100Car, '100Car')
-parameters_100Car.to_csv(data_path + 'spacing/parameters_100Car.csv', index=False)
+def solve_threshold(prob_s, prob_sc, smax, c):
+    curves = solve_curves(prob_s, prob_sc, smax, c)
+    refined = None
+    if threshold_solver == 'exact':
+        refined = refine_thresholds(prob_s, prob_sc, *curves, c, np.arange(0.05,1.,0.05))
+    return curves_to_thresholds(*curves, c, refined)
+
+
+def thresholds_to_parameters(roundvs, thresholds_list):
+    parameters = pd.DataFrame(np.vstack(thresholds_list), columns=['alpha','threshold','smax','cum_smax_s','cum_smax_sc','c'])
+    parameters.insert(0, 'round_v', np.repeat(roundvs, 19))
+    return parameters
+
+
+def density_settings():
+    # settings the cached densities and curves depend on
+    if kde_backend == 'binned':
+        settings = {'kde_backend':kde_backend, 'bw_method':bw_method, 'binned_min_samples':binned_min_samples, 'grid_step':grid_step}
+    else:
+        settings = {'kde_backend':kde_backend, 'bw_method':bw_method}
+    if threshold_solver == 'exact':
+        settings.update({'threshold_solver':threshold_solver, 'coarse_step':coarse_step, 'solver_tolerance':solver_tolerance})
+    return settings
+
+
+def solve_bin(values_s, values_sc, smax, c):
+    # densities are refitted where the job runs so that only the sample arrays are sent,
+    # and the density of s and the curves are taken from the cache when the same bin was solved before
+    key = Caching.cache_key('curves', [values_s, values_sc, [smax, c]], **density_settings())
+    curves = Caching.load_cache(cache_dir, key) if use_cache else None
+    Profiling.count('cache_hits' if curves is not None else 'cache_misses')
+    if curves is None:
+        prob_s = fit_kde(values_s)
+        density_s = None
+        if use_cache and threshold_solver == 'grid':
+            density_key = Caching.cache_key('density', [values_s], **density_settings())
+            density = Caching.load_cache(cache_dir, density_key)
+            if density is None:
+                density_s = prob_s(np.arange(0, 200, 0.1))
+                Caching.save_cache(cache_dir, density_key, cache_size, density_s=density_s)
+            else:
+                density_s = density['density_s']
+        prob_sc = fit_kde(values_sc)
+        curves = solve_curves(prob_s, prob_sc, smax, c, density_s)
+        if threshold_solver == 'exact':
+            curves = curves + (refine_thresholds(prob_s, prob_sc, *curves, c, np.arange(0.05,1.,0.05)),)
+        curves = dict(zip(['range_sc','pma','pfa','smax','cum_smax_s','cum_smax_sc','refined'], curves))
+        if use_cache:
+            Caching.save_cache(cache_dir, key, cache_size, **curves)
+    curves['c'] = c
+    return curves
+
+
+def solve_stored_bin(store, roundv, values_sc, smax, c):
+    # as solve_bin, with the samples of the bin sliced from the store where the job runs instead of sent to it
+    return solve_bin(store.bin(roundv, 's'), values_sc, smax, c)
+
+
+def compute_curves_bins(samples_toinfer, roundvs, ctype_list, loc):
+    values_s, len_s = spacing_samples_s(samples_toinfer, roundvs)
+    stored = isinstance(samples_toinfer, Storing.sample_store)
+    solve = solve_stored_bin if stored else solve_bin
+    jobs, infos = [], []
+    for ctype in ctype_list:
+        values_sc, smax_list, c_list = spacing_samples_sc(samples_toinfer, roundvs, ctype)
+        jobs.extend([((samples_toinfer, roundv) if stored else (values_s[roundv],)) + (values_sc[roundv], smax, c)
+                     for roundv, smax, c in zip(roundvs, smax_list, c_list/len_s)])
+        # bins with too few conflicts are filled from a neighbour and keep smax 0
+        infos.extend([{'ctype':ctype, 'round_v':float(roundv), 'num_s':len(values_s[roundv]), 'num_sc':len(values_sc[roundv]),
+                       'filled':bool(smax==0)} for roundv, smax in zip(roundvs, smax_list)])
+
+    # each job returns its curves with a record of its wall time, CPU time, peak RSS and counted calls
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(Profiling.measure, solve, *job, **info) for job, info in zip(jobs, infos)]
+            results = [future.result() for future in tqdm(futures, desc=loc)]
+    else:
+        results = [Profiling.measure(solve, *job, **info) for job, info in tqdm(zip(jobs, infos), desc=loc, total=len(jobs))]
+    curves_list = []
+    for curves, record in results:
+        Profiling.add_bin(record)
+        curves_list.append(curves)
+
+    return [curves_list[i*len(roundvs):(i+1)*len(roundvs)] for i in range(len(ctype_list))]
+
+
+def compute_thresholds_bins(samples_toinfer, roundvs, ctype_list, loc, curves_list=None):
+    if curves_list is None:
+        curves_list = compute_curves_bins(samples_toinfer, roundvs, ctype_list, loc)
+    parameters_list = []
+    for curves_ctype in curves_list:
+        parameters_list.append(thresholds_to_parameters(roundvs, [curves_to_thresholds(**curves) for curves in curves_ctype]))
+    return parameters_list
+
+
+def frontiers_to_arrays(roundvs, ctype_list, curves_list, alphas):
+    # one entry per (conflict type, round_v) for the scalars, the Pareto frontiers concatenated with the offsets of each bin,
+    # and the thresholds of the dense alpha sweep as a matrix
+    arrays = {'ctype':np.repeat(ctype_list, len(roundvs)), 'round_v':np.tile(roundvs, len(ctype_list)), 'alpha':np.asarray(alphas, dtype=float)}
+    curves_list = [curves for curves_ctype in curves_list for curves in curves_ctype]
+    for name in ['smax','cum_smax_s','cum_smax_sc','c']:
+        arrays[name] = np.array([float(curves[name]) for curves in curves_list])
+    frontiers = [pareto_frontier(curves['range_sc'], curves['pma'], curves['pfa']) for curves in curves_list]
+    arrays['offsets'] = np.concatenate(([0], np.cumsum([len(frontier[0]) for frontier in frontiers])))
+    for i, name in enumerate(['frontier_threshold','frontier_pma','frontier_pfa']):
+        arrays[name] = np.concatenate([frontier[i] for frontier in frontiers])
+    arrays['sweep_threshold'] = np.array([sweep_thresholds(curves['range_sc'], curves['pma'], curves['pfa'], alphas)[0] for curves in curves_list])
+    return arrays
+
+
+def frontier(arrays, ctype, roundv):
+    # thresholds, pma and pfa on the Pareto frontier of one bin, from arrays loaded from frontiers_*.npz
+    idx = np.flatnonzero((arrays['ctype']==ctype)&(arrays['round_v']==roundv))[0]
+    start, end = arrays['offsets'][idx], arrays['offsets'][idx+1]
+    return arrays['frontier_threshold'][start:end], arrays['frontier_pma'][start:end], arrays['frontier_pfa'][start:end]
+
+
+def resample_thresholds(values_s, conflict, fill_sc, c_fill, seed, num_replicates):
+    # thresholds of resamples of a bin: the samples of the bin are resampled with replacement, and the conflicts among them
+    # give s_c, smax and c; as in spacing_samples_sc, resamples with 5 conflicts or fewer borrow (a resample of) the conflicts
+    # of the nearest other bin with enough, with smax 0 and c from the smallest conflict count
+    rng = np.random.default_rng(seed)
+    thresholds = np.full((num_replicates, 19), np.nan)
+    for i in range(num_replicates):
+        index = rng.integers(0, len(values_s), len(values_s))
+        resample_s, resample_sc = values_s[index], values_s[index][conflict[index]]
+        if len(resample_sc) > 5:
+            smax, c = resample_sc.max(), len(resample_sc)/len(resample_s)
+        else:
+            resample_sc, smax, c = fill_sc[rng.integers(0, len(fill_sc), len(fill_sc))], 0, c_fill
+        # resamples of identical spacings have no density, and are left out of the intervals
+        if np.ptp(resample_s) == 0 or np.ptp(resample_sc) == 0:
+            continue
+        thresholds[i] = solve_threshold(fit_kde(resample_s), fit_kde(resample_sc), smax, c)[:,1]
+    return thresholds
+
+
+def resample_stored_thresholds(store, roundv, ctype, fill_sc, c_fill, seed, num_replicates):
+    # as resample_thresholds, with the samples of the bin sliced from the store where the job runs instead of sent to it
+    values_s, conflict = store.bin(roundv, 's'), store.bin(roundv, ctype)
+    return resample_thresholds(values_s.astype(float), conflict.astype(bool), fill_sc, c_fill, seed, num_replicates)
+
+
+def bootstrap_thresholds(samples_toinfer, roundvs, ctype_list, loc):
+    # percentile intervals of the thresholds per (conflict type, round_v, alpha), from bootstrap_replicates resamples of each bin
+    # solved in batches of bootstrap_batch, so that a job is sent (or slices) the samples of its bin once for several replicates,
+    # while each replicate fits its own densities; the seeds depend on the bin and batch only, so results do not depend on num_workers
+    bins = [bin_samples(samples_toinfer, roundv, ['s']+ctype_list) for roundv in roundvs]
+    stored = isinstance(samples_toinfer, Storing.sample_store)
+    resample = resample_stored_thresholds if stored else resample_thresholds
+    jobs, infos = [], []
+    for k, ctype in enumerate(ctype_list):
+        conflicts = [columns[k+1].astype(bool) for columns in bins]
+        num_sc = np.array([conflict.sum() for conflict in conflicts])
+        idx_unempty = np.flatnonzero(num_sc > 5)
+        for i, roundv in enumerate(roundvs):
+            idx_others = idx_unempty[idx_unempty!=i] if len(idx_unempty) > 1 else idx_unempty
+            fillin_idx = idx_others[np.argmin(np.abs(idx_others-i))]
+            num_s = len(bins[i][0])
+            fill_sc = bins[fillin_idx][0][conflicts[fillin_idx]].astype(float)
+            for start in range(0, bootstrap_replicates, bootstrap_batch):
+                seed = [bootstrap_seed, k, i, start]
+                samples_bin = (samples_toinfer, roundv, ctype) if stored else (bins[i][0].astype(float), conflicts[i])
+                jobs.append(samples_bin + (fill_sc, num_sc[idx_unempty].min()/num_s, seed, min(bootstrap_batch, bootstrap_replicates-start)))
+                infos.append({'ctype':ctype, 'round_v':float(roundv), 'num_s':num_s, 'num_sc':int(num_sc[i]), 'replicates':jobs[-1][-1]})
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(Profiling.measure, resample, *job, **info) for job, info in zip(jobs, infos)]
+            results = [future.result() for future in tqdm(futures, desc=loc+' bootstrap')]
+    else:
+        results = [Profiling.measure(resample, *job, **info) for job, info in tqdm(zip(jobs, infos), desc=loc+' bootstrap', total=len(jobs))]
+    replicates = {}
+    for thresholds, record in results:
+        Profiling.add_bin(record)
+        replicates.setdefault((record['ctype'], record['round_v']), []).append(thresholds)
+
+    intervals = []
+    percentiles = 100*np.array([(1-bootstrap_level)/2, 0.5, (1+bootstrap_level)/2])
+    for (ctype, roundv), thresholds in replicates.items():
+        thresholds = np.vstack(thresholds)
+        valid = ~np.isnan(thresholds).any(axis=1)
+        lower, median, upper = np.percentile(thresholds[valid], percentiles, axis=0) if valid.any() else np.full((3,19), np.nan)
+        intervals.append(pd.DataFrame({'ctype':ctype, 'round_v':roundv, 'alpha':np.arange(0.05,1.,0.05),
+                                       'lower':lower, 'median':median, 'upper':upper, 'num_replicates':valid.sum()}))
+    return pd.concat(intervals).reset_index(drop=True)
+
+
+def compute_dataset(loc):
+    # thresholds and Pareto frontiers of one dataset, for the conflict columns of its samples to infer
+    ## Load data
+    print('Loading '+loc+' data...')
+    with Profiling.stage(loc+' load') as record:
+        if use_store:
+            samples_toinfer = load_store(loc)
+            roundvs, ctype_list = samples_toinfer.roundvs, samples_toinfer.ctypes
+        else:
+            samples_loc, samples_toinfer, roundvs = load_data(loc)
+            ctype_list = [column for column in samples_toinfer.columns if column.startswith('conflict')]
+        record.update({'num_samples':len(samples_toinfer), 'num_bins':len(roundvs)})
+    if kde_backend == 'binned' and binned_accuracy_report:
+        with Profiling.stage(loc+' binned accuracy'):
+            accuracy = [binned_accuracy(samples_toinfer, roundvs, loc, ctype) for ctype in [None]+ctype_list]
+        pd.concat(accuracy).to_csv(data_path + 'spacing/binned_accuracy_'+loc+'.csv', index=False)
+
+    ## Compute pma and pfa
+    print('Computing thresholds...')
+    with Profiling.stage(loc+' curves', num_samples=len(samples_toinfer), num_bins=len(roundvs)*len(ctype_list)):
+        curves = compute_curves_bins(samples_toinfer, roundvs, ctype_list, loc)
+    # workers count only the entries they saved themselves, so the cache is checked once more with all of them
+    if use_cache and os.path.isdir(cache_dir):
+        Caching.evict_cache(cache_dir, cache_size)
+    with Profiling.stage(loc+' thresholds'):
+        parameters = compute_thresholds_bins(samples_toinfer, roundvs, ctype_list, loc, curves)
+    if bootstrap_replicates > 0:
+        with Profiling.stage(loc+' bootstrap', replicates=bootstrap_replicates):
+            intervals = bootstrap_thresholds(samples_toinfer, roundvs, ctype_list, loc)
+        intervals.insert(3, 'threshold', np.concatenate([parameters_ctype['threshold'].values for parameters_ctype in parameters]))
+        intervals.to_csv(data_path + 'spacing/bootstrap_'+loc+'.csv', index=False)
+    # empirical conflicts are of a single type, whose parameters have no ctype column
+    if ctype_list == ['conflict']:
+        parameters = parameters[0]
+    else:
+        for parameters_ctype, ctype in zip(parameters, ctype_list):
+            parameters_ctype['ctype'] = ctype
+        parameters = pd.concat(parameters).reset_index(drop=True)
+    parameters.to_csv(data_path + 'spacing/parameters_'+loc+'.csv', index=False)
+    with Profiling.stage(loc+' frontiers'):
+        np.savez(data_path + 'spacing/frontiers_'+loc+'.npz', **frontiers_to_arrays(roundvs, ctype_list, curves, sweep_alphas))
+
+
+if __name__ == '__main__':
+    # Freeway B
+    compute_dataset('FreewayB')
+
+    # 100Car
+    compute_dataset('100Car')
+
+    ## Report the run
+    Profiling.write_report('Computing', num_workers=num_workers, use_cache=use_cache, use_store=use_store,
+                           binned_accuracy_report=binned_accuracy_report, **density_settings())
@@ -0,0 +1,196 @@
+'''
+This file is used to compute the thresholds from one binned density over (s, v) per sample set, instead of one KDE per round_v,
+so that the densities of s given v, and thresholds, can be derived at any relative speed.
+'''
+
+# Import libraries
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from scipy import stats
+from scipy import signal
+import Computing
+import Profiling
+
+# Define the directory of the project
+data_path = './localdata/'
+
+# Define settings
+s_step = 0.05 # spacing (m) of the grid along s, as grid_step in Computing.py
+v_step = 0.1 # speed (m/s) of the grid along v, densities between grid speeds are linearly interpolated
+s_limit = 500. # spacing (m), larger spacings are binned at the end of the grid, as in Updating.py
+speed_step = 0.1 # m/s, thresholds are derived on a grid of this step from 0 to the largest round_v, and at every round_v
+min_conflicts = 5 # speeds with this many conflicts or fewer around them borrow the conflicts of the nearest speed with more, as bins do in Computing.py
+
+
+# Define functions
+def bandwidth_factor(n):
+    # the 1-D rule of bw_method in Computing.py, for a sample of (effective) size n
+    if Computing.bw_method == 'silverman':
+        return (n*3/4.)**(-1./5)
+    else:
+        return n**(-1./5)
+
+
+def bilinear_binning(s, v, grid_s, grid_v):
+    # each sample is shared between its four neighbouring grid points, as linear_binning in Computing.py along each axis
+    position_s, position_v = (s-grid_s[0])/s_step, (v-grid_v[0])/v_step
+    left_s, left_v = np.floor(position_s).astype(int), np.floor(position_v).astype(int)
+    fraction_s, fraction_v = position_s-left_s, position_v-left_v
+    shape = (len(grid_s)+1, len(grid_v)+1)
+    counts = np.zeros(shape[0]*shape[1])
+    for shift_s, weight_s in [(0, 1-fraction_s), (1, fraction_s)]:
+        for shift_v, weight_v in [(0, 1-fraction_v), (1, fraction_v)]:
+            counts += np.bincount((left_s+shift_s)*shape[1]+left_v+shift_v, weights=weight_s*weight_v, minlength=len(counts))
+    return counts.reshape(shape)[:len(grid_s),:len(grid_v)]
+
+
+class joint_kde():
+    # linearly binned counts over an (s, v) grid, smoothed once along v with a gaussian kernel whose bandwidth follows bw_method
+    # on all speeds, unless given; the density of s given v is the binned_kde of the smoothed counts at v, whose bandwidth follows
+    # bw_method on the variance and effective size of the samples weighted by the kernel, as a round_v bin of samples around v would
+    def __init__(self, s, v, bandwidth_v=None):
+        super().__init__()
+        Profiling.count('joint_fits')
+        s = np.minimum(np.asarray(s, dtype=float), s_limit)
+        v = np.asarray(v, dtype=float)
+        self.n = len(s)
+        self.v_range = (v.min(), v.max())
+        self.bandwidth_v = np.std(v, ddof=1)*bandwidth_factor(self.n) if bandwidth_v is None else bandwidth_v
+        offsets = np.arange(-np.ceil(8.5*self.bandwidth_v/v_step), np.ceil(8.5*self.bandwidth_v/v_step)+1)*v_step
+        kernel = stats.norm.pdf(offsets/self.bandwidth_v)/self.bandwidth_v
+        self.grid_v = np.arange(np.floor(v.min()/v_step), np.ceil(v.max()/v_step)+2)*v_step
+
+        # kernel weighted sums of 1, s and s**2 around each grid speed, and of the squared kernel for the effective size
+        moments = np.array([Computing.linear_binning(v, self.grid_v[0], v_step, len(self.grid_v), weights) for weights in [None, s, s**2]])
+        self.weight_v, sum_s, sum_s2 = self.smooth(moments, kernel)
+        sum_kernel2 = self.smooth(moments[0], kernel**2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.size_v = np.where(sum_kernel2 > 0, self.weight_v**2/sum_kernel2, 0.)
+            variance = np.where(self.weight_v > 0, sum_s2/self.weight_v - (sum_s/self.weight_v)**2, 0.)
+        self.bandwidth_s = np.sqrt(np.maximum(variance, s_step**2))*bandwidth_factor(np.maximum(self.size_v, 2.))
+
+        # the grid along s covers 8.5 times the largest bandwidth beyond the samples, as in binned_kde
+        margin = 8.5*self.bandwidth_s.max()
+        self.grid_s = np.arange(np.floor((s.min()-margin)/s_step), np.ceil((s.max()+margin)/s_step)+1)*s_step
+        self.counts = self.smooth(bilinear_binning(s, v, self.grid_s, self.grid_v), kernel)
+
+
+    # Convolution along v, the last axis
+    def smooth(self, counts, kernel):
+        kernel = kernel.reshape((1,)*(counts.ndim-1) + (-1,))
+        return np.clip(signal.fftconvolve(counts, kernel, mode='same', axes=-1), 0, None)
+
+
+    def interpolate(self, v, rows):
+        # speeds beyond the samples take the density at the nearest end
+        position = (np.clip(v, *self.v_range)-self.grid_v[0])/v_step
+        left = min(int(np.floor(position)), len(self.grid_v)-2)
+        fraction = position - left
+        return (1-fraction)*rows[...,left] + fraction*rows[...,left+1]
+
+
+    def weight(self, v):
+        # n times the density of v
+        return self.interpolate(v, self.weight_v)
+
+
+    def effective_size(self, v):
+        return self.interpolate(v, self.size_v)
+
+
+    def kernel_count(self, v):
+        # samples around v, each counted with the kernel relative to its peak: 1 at v and less further away
+        return self.weight(v)*self.bandwidth_v*np.sqrt(2*np.pi)
+
+
+    def conditional(self, v):
+        counts = self.interpolate(v, self.counts)
+        bandwidth = self.interpolate(v, self.bandwidth_s)
+        return Computing.binned_kde(bw_method=1., grid_step=s_step, counts=counts, grid=self.grid_s, n=counts.sum(), variance=bandwidth**2)
+
+
+def conditional_thresholds(joint_s, joint_sc, v, v_fill=None, weight_fill=None):
+    prob_s = joint_s.conditional(v)
+    if v_fill is None:
+        # the largest of n conflicts is expected at the n/(n+1) quantile, and the share of conflicts around v is the ratio of the
+        # kernel weights of conflicts and of all samples, smoothed along v with the same bandwidth
+        prob_sc = joint_sc.conditional(v)
+        size_sc = joint_sc.effective_size(v)
+        smax = prob_sc.grid[min(np.searchsorted(prob_sc.cdf_grid, size_sc/(size_sc+1)), len(prob_sc.grid)-1)]
+        c = min(joint_sc.weight(v)/joint_s.weight(v), 1.)
+    else:
+        # too few conflicts around v: the conflicts of v_fill, smax 0 and c from the smallest kernel weight of conflicts
+        # weight_fill among the speeds with enough, as spacing_samples_sc in Computing.py fills bins
+        prob_sc = joint_sc.conditional(v_fill)
+        smax, c = 0., min(weight_fill/joint_s.weight(v), 1.)
+    return Computing.solve_threshold(prob_s, prob_sc, max(smax, 0.), c)
+
+
+def fill_speeds(joint_sc, speeds):
+    # the nearest speed with more than min_conflicts conflicts around it for each speed, None where it has enough itself,
+    # and the smallest kernel weight of conflicts among the speeds with enough; no speed has enough without conflicts
+    enough = np.array([joint_sc.kernel_count(v) > min_conflicts for v in speeds])
+    if not enough.any():
+        return None, None
+    speeds_enough = speeds[enough]
+    v_fill = [None if enough[i] else speeds_enough[np.argmin(np.abs(speeds_enough-v))] for i, v in enumerate(speeds)]
+    return v_fill, min([joint_sc.weight(v) for v in speeds_enough])
+
+
+def compute_joint(samples_toinfer, speeds, ctype_list, loc):
+    # conflicts are smoothed along v as all samples, a wider bandwidth would mix conflicts of distant speeds where they are few
+    with Profiling.stage(loc+' joint fits', num_samples=len(samples_toinfer), num_ctypes=len(ctype_list)):
+        joint_s = joint_kde(samples_toinfer['s'].values, samples_toinfer['v'].values)
+        joint_sc = {}
+        for ctype in ctype_list:
+            conflicts = samples_toinfer[samples_toinfer[ctype]]
+            joint_sc[ctype] = joint_kde(conflicts['s'].values, conflicts['v'].values, joint_s.bandwidth_v)
+
+    parameters_list = []
+    for ctype in ctype_list:
+        with Profiling.stage(loc+' '+ctype+' thresholds', num_speeds=len(speeds)) as record:
+            v_fill, weight_fill = fill_speeds(joint_sc[ctype], speeds)
+            if v_fill is None:
+                # without conflicts there is nothing to borrow, and the thresholds are left nan
+                thresholds_list = [np.column_stack((np.arange(0.05,1.,0.05), np.full((19,5), np.nan)))]*len(speeds)
+                record['num_filled'] = len(speeds)
+            else:
+                thresholds_list = [conditional_thresholds(joint_s, joint_sc[ctype], v, fill, weight_fill)
+                                   for v, fill in tqdm(zip(speeds, v_fill), desc=loc+' '+ctype, total=len(speeds))]
+                record['num_filled'] = sum([fill is not None for fill in v_fill])
+        parameters_list.append(Computing.thresholds_to_parameters(speeds, thresholds_list))
+    return parameters_list
+
+
+def compute_dataset(loc):
+    ## Load data
+    print('Loading '+loc+' data...')
+    samples_toinfer = pd.read_hdf(data_path + 'samples/samples_toinfer_'+loc+'.h5', key='samples')
+    roundvs = np.sort(samples_toinfer['round_v'].unique())
+    speeds = np.union1d(np.round(np.arange(0, roundvs.max()+speed_step/2, speed_step), 2), roundvs)
+    ctype_list = [column for column in samples_toinfer.columns if column.startswith('conflict')]
+
+    ## Compute thresholds at each speed
+    print('Computing thresholds...')
+    parameters = compute_joint(samples_toinfer, speeds, ctype_list, loc)
+    # as in Computing.py, empirical conflicts are of a single type, whose parameters have no ctype column
+    if ctype_list == ['conflict']:
+        parameters = parameters[0]
+    else:
+        for parameters_ctype, ctype in zip(parameters, ctype_list):
+            parameters_ctype['ctype'] = ctype
+        parameters = pd.concat(parameters).reset_index(drop=True)
+    parameters.to_csv(data_path + 'spacing/parameters_joint_'+loc+'.csv', index=False)
+
+
+if __name__ == '__main__':
+    # Freeway B
+    compute_dataset('FreewayB')
+
+    # 100Car
+    compute_dataset('100Car')
+
+    ## Report the run
+    Profiling.write_report('Conditioning', s_step=s_step, v_step=v_step, s_limit=s_limit, speed_step=speed_step,
+                           bw_method=Computing.bw_method, threshold_solver=Computing.threshold_solver)
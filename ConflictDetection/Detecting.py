@@ -0,0 +1,123 @@
+'''
+This file is used to detect conflicts with the thresholds computed by Computing.py.
+'''
+
+# Import libraries
+import time
+import bisect
+import pandas as pd
+import numpy as np
+
+# Define the directory of the project
+data_path = './localdata/'
+
+
+# Define classes and functions
+class ConflictDetector():
+    def __init__(self, parameters):
+        super().__init__()
+        if isinstance(parameters, str):
+            parameters = pd.read_csv(parameters)
+        if 'ctype' not in parameters.columns:
+            parameters = parameters.assign(ctype='conflict')
+        self.ctypes = np.sort(parameters['ctype'].unique())
+        self.alphas = np.sort(parameters['alpha'].unique())
+        self.roundvs = np.sort(parameters['round_v'].unique())
+
+        # thresholds[ctype, alpha, round_v], sorted along each axis
+        self.thresholds = np.full((len(self.ctypes), len(self.alphas), len(self.roundvs)), np.nan)
+        idx_ctype = np.searchsorted(self.ctypes, parameters['ctype'].values)
+        idx_alpha = np.searchsorted(self.alphas, parameters['alpha'].values)
+        idx_roundv = np.searchsorted(self.roundvs, parameters['round_v'].values)
+        self.thresholds[idx_ctype, idx_alpha, idx_roundv] = parameters['threshold'].values
+
+        # as in round_speed, speeds are assigned to the nearest round_v and ties go to the larger one,
+        # so the bin is the number of midpoints between neighbouring round_v not above the speed
+        self.midpoints = (self.roundvs[1:] + self.roundvs[:-1])/2
+        self.midpoints_list = self.midpoints.tolist()
+        self.tables = {}
+
+
+    def index_ctype(self, ctype):
+        if ctype is None:
+            if len(self.ctypes) > 1:
+                raise ValueError('ctype must be one of '+str(list(self.ctypes)))
+            return 0
+        idx = np.searchsorted(self.ctypes, ctype)
+        if idx == len(self.ctypes) or self.ctypes[idx] != ctype:
+            raise ValueError('ctype must be one of '+str(list(self.ctypes)))
+        return idx
+
+
+    def index_alpha(self, alpha):
+        # alphas are stored as written by np.arange, so they are matched with a tolerance
+        idx = np.argmin(np.abs(self.alphas - alpha))
+        if abs(self.alphas[idx] - alpha) > 1e-6:
+            raise ValueError('alpha must be one of '+str(np.round(self.alphas, 6).tolist()))
+        return idx
+
+
+    def threshold_table(self, alpha, ctype=None):
+        return self.thresholds[self.index_ctype(ctype), self.index_alpha(alpha)]
+
+
+    def round_speed(self, v):
+        return self.roundvs[np.searchsorted(self.midpoints, v, side='right')]
+
+
+    def classify(self, table, s, v):
+        # only approaching pairs at a positive spacing can be in conflict, as in the samples the thresholds are inferred from;
+        # the thresholds of table are along its last axis, by round_v
+        return (s > 0) & (v > 0) & (s <= table[..., np.searchsorted(self.midpoints, v, side='right')])
+
+
+    def detect(self, s, v, alpha, ctype=None):
+        return self.classify(self.threshold_table(alpha, ctype), np.asarray(s), np.asarray(v))
+
+
+    # For all conflict types at once, one row per type of self.ctypes
+    def detect_types(self, s, v, alpha):
+        return self.classify(self.thresholds[:, self.index_alpha(alpha)], np.asarray(s), np.asarray(v))
+
+
+    # For one pair at a time, e.g. in a forward collision warning loop, without numpy overhead
+    def detect_pair(self, s, v, alpha, ctype=None):
+        key = (alpha, ctype)
+        if key not in self.tables:
+            self.tables[key] = self.threshold_table(alpha, ctype).tolist()
+        return s > 0 and v > 0 and s <= self.tables[key][bisect.bisect_right(self.midpoints_list, v)]
+
+
+def benchmark(detector, alpha, ctype=None, ttc_star=3., num_pairs=10**7, num_single=10**5):
+    rng = np.random.default_rng(0)
+    s = rng.uniform(0, 100, num_pairs)
+    v = rng.uniform(0, detector.roundvs.max()*1.1, num_pairs)
+
+    results = []
+    start = time.perf_counter()
+    detector.detect(s, v, alpha, ctype)
+    results.append(['spacing (vectorised)', num_pairs/(time.perf_counter()-start)])
+
+    start = time.perf_counter()
+    s <= (ttc_star*v)
+    results.append(['TTC (vectorised)', num_pairs/(time.perf_counter()-start)])
+
+    s_list, v_list = s[:num_single].tolist(), v[:num_single].tolist()
+    start = time.perf_counter()
+    for s_pair, v_pair in zip(s_list, v_list):
+        detector.detect_pair(s_pair, v_pair, alpha, ctype)
+    results.append(['spacing (single pair)', num_single/(time.perf_counter()-start)])
+
+    start = time.perf_counter()
+    for s_pair, v_pair in zip(s_list, v_list):
+        s_pair <= (ttc_star*v_pair)
+    results.append(['TTC (single pair)', num_single/(time.perf_counter()-start)])
+
+    return pd.DataFrame(results, columns=['method','pairs_per_second'])
+
+
+if __name__ == '__main__':
+    detector = ConflictDetector(data_path + 'spacing/parameters_FreewayB.csv')
+    for ctype in detector.ctypes:
+        print(ctype)
+        print(benchmark(detector, 0.5, ctype))
@@ -0,0 +1,105 @@
+'''
+This file is used to count missed and false alarms of the spacing thresholds and of TTC thresholds over all samples, one chunk at a time.
+'''
+
+# Import libraries
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+import Profiling
+from Detecting import ConflictDetector
+
+# Define the directory of the project
+data_path = './localdata/'
+
+# Define settings
+chunk_size = 10**6 # rows read and counted at a time, memory is bounded by it rather than by the size of the samples
+ttc_stars = np.round(np.arange(2.1,4,0.1), 2) # TTC thresholds (s) to compare with, as in IEEE IV.ipynb
+
+
+# Define functions
+def iter_samples(path, key='data'):
+    # chunks of chunk_size rows, from samples saved by to_hdf or appended by the streaming mode of Sampling.py
+    with pd.HDFStore(path, mode='r') as store:
+        storer = store.get_storer(key)
+        num_rows = storer.nrows if storer.is_table else storer.shape[0]
+        for start in range(0, num_rows, chunk_size):
+            yield store.select(key, start=start, stop=start+chunk_size)
+
+
+def count_spacing(thresholds, s, idx_bin, conflicts):
+    # detected and correctly detected conflicts per (ctype, alpha); rows are sorted by bin and spacing once, so that
+    # the rows of a bin with s <= threshold are counted by binary search for all thresholds of the bin at once
+    order = np.lexsort((s, idx_bin))
+    s, idx_bin = s[order], idx_bin[order]
+    cum_conflicts = np.concatenate((np.zeros((1, conflicts.shape[1]), dtype=np.int64), np.cumsum(conflicts[order], axis=0)))
+    num_ctypes, num_alphas, num_bins = thresholds.shape
+    detected = np.zeros((num_ctypes, num_alphas), dtype=np.int64)
+    true_positive = np.zeros((num_ctypes, num_alphas), dtype=np.int64)
+    starts = np.searchsorted(idx_bin, np.arange(num_bins+1))
+    for idx in np.flatnonzero(np.diff(starts) > 0):
+        start, end = starts[idx], starts[idx+1]
+        # bins without a threshold detect nothing
+        position = start + np.searchsorted(s[start:end], np.nan_to_num(thresholds[:,:,idx], nan=-np.inf), side='right')
+        detected += position - start
+        true_positive += cum_conflicts[position, np.arange(num_ctypes)[:,np.newaxis]] - cum_conflicts[start][:,np.newaxis]
+    return detected, true_positive
+
+
+def count_ttc(ttc, conflicts):
+    # a row is detected by every TTC threshold from the first one at or above its TTC on, so the counts per threshold
+    # are cumulative counts of that first threshold
+    first = np.searchsorted(ttc_stars, ttc, side='left')
+    detected = np.cumsum(np.bincount(first, minlength=len(ttc_stars)+1))[:-1]
+    true_positive = np.cumsum([np.bincount(first, weights=conflicts[:,i], minlength=len(ttc_stars)+1) for i in range(conflicts.shape[1])], axis=1)[:,:-1]
+    return np.broadcast_to(detected, true_positive.shape), true_positive.astype(np.int64)
+
+
+def confusion_counts(loc, ctype, method, thresholds, detected, true_positive, num_conflicts, num_samples):
+    false_positive = detected - true_positive
+    false_negative = num_conflicts - true_positive
+    true_negative = num_samples - detected - false_negative
+    return pd.DataFrame({'dataset':loc, 'conflict':ctype, 'method':method, 'threshold':thresholds,
+                         'tp':true_positive, 'fp':false_positive, 'tn':true_negative, 'fn':false_negative,
+                         'sum_all':num_samples, 'num_conflicts':num_conflicts})
+
+
+def evaluate(loc, samples_file=None, key='data'):
+    # counts of all samples of a dataset by default; speeds are assigned to round_v with the round_speed mapping,
+    # unless the samples have round_v already, as the samples to infer used in IEEE IV.ipynb
+    detector = ConflictDetector(data_path + 'spacing/parameters_'+loc+'.csv')
+    samples_file = data_path + 'samples/samples_'+loc+'.h5' if samples_file is None else samples_file
+    num_ctypes = len(detector.ctypes)
+    num_samples, num_conflicts = 0, np.zeros(num_ctypes, dtype=np.int64)
+    spacing_counts = np.zeros((2, num_ctypes, len(detector.alphas)), dtype=np.int64)
+    ttc_counts = np.zeros((2, num_ctypes, len(ttc_stars)), dtype=np.int64)
+
+    for chunk in tqdm(iter_samples(samples_file, key), desc=loc):
+        s, v = chunk['s'].values.astype(float), chunk['v'].values.astype(float)
+        conflicts = chunk[detector.ctypes].values.astype(bool)
+        if 'round_v' in chunk.columns:
+            idx_bin = np.searchsorted(detector.roundvs, chunk['round_v'].values)
+        else:
+            idx_bin = np.searchsorted(detector.midpoints, v, side='right')
+        num_samples += len(chunk)
+        num_conflicts += conflicts.sum(axis=0)
+        spacing_counts += count_spacing(detector.thresholds, s, idx_bin, conflicts)
+        ttc_counts += count_ttc(s/v, conflicts)
+
+    results = []
+    for i, ctype in enumerate(detector.ctypes):
+        results.append(confusion_counts(loc, ctype, 'TTC', ttc_stars, *ttc_counts[:,i], num_conflicts[i], num_samples))
+        results.append(confusion_counts(loc, ctype, 'MFaM', np.round(detector.alphas, 2), *spacing_counts[:,i], num_conflicts[i], num_samples))
+    return pd.concat(results).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    for loc in ['FreewayB', '100Car']:
+        with Profiling.stage(loc+' evaluation') as record:
+            results = evaluate(loc)
+            record['num_samples'] = int(results['sum_all'].iloc[0])
+        results.to_csv(data_path + 'evaluation_'+loc+'.csv', index=False)
+        print(loc+': evaluation saved in '+data_path + 'evaluation_'+loc+'.csv')
+
+    ## Report the run
+    Profiling.write_report('Evaluating', chunk_size=chunk_size)
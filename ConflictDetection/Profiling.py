@@ -0,0 +1,148 @@
+'''
+This file is used to record the wall time, CPU time, peak memory and call counts of the pipeline stages and speed bins, and to write them as a run report.
+'''
+
+# Import libraries
+import os
+import sys
+import json
+import time
+import contextlib
+from collections import Counter
+
+# Define the directory of the project
+data_path = './localdata/'
+
+# Define settings
+report_runs = True # write a report of each run of Sampling.py and Computing.py
+report_dir = data_path + 'reports/'
+profile_stage = None # name of a stage to profile, e.g. 'FreewayB curves', None to profile nothing
+profiler = 'cprofile' # 'cprofile' for deterministic profiling, 'pyinstrument' for sampling (optional dependency)
+
+# Records of the current run
+counters = Counter() # calls counted with count(), e.g. kde_fits and cdf_evaluations
+stages, bins = [], []
+open_stages = []
+
+
+# Define functions
+def count(name, number=1):
+    counters[name] += number
+
+
+def peak_rss():
+    # MB, from VmHWM on Linux, which reset_peak() can reset, otherwise the peak of the whole process from ru_maxrss
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/1024**2 if sys.platform == 'darwin' else maxrss/1024
+
+
+def reset_peak():
+    # the peak so far is kept by the open stages before it is reset, so that nested records do not lose it
+    peak = peak_rss()
+    for record in open_stages:
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def cpu_time():
+    # user and system time of this process and of its finished child processes, e.g. the workers of a process pool
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def start_profiler():
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    return profile
+
+
+def stop_profiler(profile, name):
+    os.makedirs(report_dir, exist_ok=True)
+    path = report_dir + 'profile_' + name.replace(' ', '_') + '_' + time.strftime('%Y%m%d-%H%M%S')
+    if profiler == 'pyinstrument':
+        profile.stop()
+        with open(path + '.html', 'w') as file:
+            file.write(profile.output_html())
+        print(profile.output_text())
+        return path + '.html'
+    import pstats
+    profile.disable()
+    profile.dump_stats(path + '.prof')
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+    return path + '.prof'
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    # wall time, CPU time, peak RSS and counted calls of a stage; the record can be completed inside, e.g. with sample counts
+    record = {'stage':name, **info, 'peak_rss_mb':0.}
+    reset_peak()
+    open_stages.append(record)
+    counters_before = counters.copy()
+    profile = start_profiler() if name == profile_stage else None
+    start, start_cpu = time.perf_counter(), cpu_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - start
+        record['cpu_seconds'] = cpu_time() - start_cpu
+        if profile is not None:
+            record['profile'] = stop_profiler(profile, name)
+        open_stages.remove(record)
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss())
+        record['calls'] = dict(counters - counters_before)
+        stages.append(record)
+
+
+def measure(function, *args, **info):
+    # call function and return its result with a record of the call; the counted calls are moved from this process
+    # to the record, so that add_bin() counts them once whether the call ran here or in a worker
+    counters_before = counters.copy()
+    reset_peak()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+    record = {**info, 'wall_seconds':time.perf_counter() - start, 'cpu_seconds':time.process_time() - start_cpu, 'peak_rss_mb':peak_rss()}
+    counted = counters - counters_before
+    counters.subtract(counted)
+    record['calls'] = dict(counted)
+    return result, record
+
+
+def add_bin(record):
+    # bins are recorded with the stage they are solved in
+    counters.update(record['calls'])
+    bins.append({'stage':open_stages[-1]['stage'] if len(open_stages) > 0 else None, **record})
+
+
+def write_report(name, **settings):
+    # one json file per run, with the stages in order, the bins and the totals of the counted calls
+    if not report_runs:
+        return None
+    os.makedirs(report_dir, exist_ok=True)
+    path = report_dir + name + '_' + time.strftime('%Y%m%d-%H%M%S') + '.json'
+    report = {'name':name, 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'settings':settings,
+              'stages':stages, 'bins':bins, 'counters':dict(counters)}
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, default=float)
+    print('Run report saved in ' + path)
+    return path
@@ -0,0 +1,258 @@
+'''
+This file is used to replay the preprocessed trajectories frame by frame, as a sensor would deliver them, to measure whether
+the spacing thresholds can raise warnings at the frame rate, and how long after the onset of a conflict the warning comes.
+'''
+
+# Import libraries
+import time
+import asyncio
+from dataclasses import dataclass
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+import Profiling
+import Sampling
+from Detecting import ConflictDetector
+
+# Define the directory of the project
+data_path = './localdata/'
+
+# Define settings
+alpha = 0.5 # warnings are raised with the thresholds of this alpha
+mode = 'serial' # 'serial' to replay the streams one after another as fast as possible, 'asyncio' to replay all streams at once at their frame rate
+speedup = 1. # in the asyncio mode, frames arrive this many times faster than recorded
+frame_rates = {'FreewayB':30., '100Car':10.} # Hz, a frame should be processed within 1/(frame_rate*speedup) s
+time_units = {'FreewayB':1/30., '100Car':0.01} # seconds per unit of frame_id
+max_gap = 0.5 # s, vehicles and pairs missing for longer are forgotten, and their conflicts end
+percentiles = [50, 90, 99]
+
+
+# Define functions
+def load_streams(loc, files, ctypes):
+    # one stream per lane of each FreewayB recording and per 100Car trip, as columns sorted by frame_id;
+    # conflicts are determined offline from the rows, as in Sampling.py, only to evaluate the warnings
+    streams = []
+    for file in files:
+        if loc == 'FreewayB':
+            data = Sampling.load_outputdata(file, ['laneId','frame_id','track_id','precedingId']+Sampling.freewayb_columns)
+            data['s'] = abs(data['pre_position'] - data['position']) - data['pre_length']
+            data['v'] = data['speed'] - data['pre_speed']
+            data = Sampling.determine_conflicts(data)
+            data[ctypes] = data[ctypes].values & (data[['s','v']].values>0).all(axis=1, keepdims=True)
+            keys, columns = ['laneId'], ['frame_id','track_id','precedingId','position','speed','length','pre_position','pre_speed','pre_length']
+        else:
+            data = pd.read_hdf(data_path + 'outputdata/'+file+'.h5', key='data')
+            keys, columns = ['track_id'], ['frame_id','track_id','s','v']
+        data = data.sort_values(keys+['frame_id'], kind='stable')
+        for key, stream in data.groupby(keys, sort=False):
+            name = file+':'+':'.join([str(value) for value in np.atleast_1d(key)])
+            streams.append((name, {column:stream[column].values for column in columns}, stream[ctypes].values))
+    return streams
+
+
+@dataclass
+class pair_state():
+    # per conflict type of a (follower, leader) pair: whether it is in conflict, the frame its current conflict started,
+    # the frame its current warning started, and whether the delay of the warning was recorded for the current conflict
+    last_frame: int
+    in_conflict: list
+    onset: list
+    warning_start: list
+    warned: list
+
+
+class replay_stream():
+    # the states of the vehicles and (follower, leader) pairs of one lane or recording, updated one frame at a time;
+    # classify is what runs online, record only keeps track of conflicts and warnings to evaluate them
+    def __init__(self, name, columns, conflicts, detector, time_unit):
+        super().__init__()
+        self.name, self.columns, self.conflicts = name, columns, conflicts
+        self.detector = detector
+        self.ctypes = list(detector.ctypes)
+        self.time_unit = time_unit
+        self.max_gap = max_gap/time_unit
+        self.vehicles, self.pairs = {}, {}
+        self.last_pruned = -np.inf
+        self.latencies, self.delays = {'classify':[], 'arrival':[]}, []
+        self.num_pairs = 0
+
+
+    def frames(self):
+        # slices of the rows of each frame
+        frame_id = self.columns['frame_id']
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(frame_id))+1, [len(frame_id)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield int(frame_id[start]), slice(start, end)
+
+
+    def classify(self, frame_id, rows):
+        # spacing and relative speed of each pair, from the latest state of the leader when the frame does not have it
+        if 's' in self.columns:
+            keys = self.columns['track_id'][rows].tolist()
+            s, v = self.columns['s'][rows], self.columns['v'][rows]
+            index = np.arange(len(keys))
+        else:
+            # leaders are observed with their followers, and the first vehicle of a lane only so
+            for prefix, ids in [('pre_', 'precedingId'), ('', 'track_id')]:
+                vehicles = zip(self.columns[ids][rows].tolist(), self.columns[prefix+'position'][rows].tolist(),
+                               self.columns[prefix+'speed'][rows].tolist(), self.columns[prefix+'length'][rows].tolist())
+                for track_id, position, speed, length in vehicles:
+                    if position == position:
+                        self.vehicles[track_id] = (frame_id, position, speed, length)
+            keys, s, v, index = [], [], [], []
+            for i, (track_id, leader_id) in enumerate(zip(self.columns['track_id'][rows].tolist(), self.columns['precedingId'][rows].tolist())):
+                leader = self.vehicles.get(leader_id)
+                if leader is not None and frame_id - leader[0] <= self.max_gap:
+                    follower = self.vehicles[track_id]
+                    keys.append((track_id, leader_id))
+                    s.append(abs(leader[1] - follower[1]) - leader[3])
+                    v.append(follower[2] - leader[2])
+                    index.append(i)
+            s, v = np.array(s), np.array(v)
+        warnings = self.detector.detect_types(s, v, alpha)
+        return keys, index, warnings
+
+
+    def record(self, frame_id, rows, keys, index, warnings):
+        conflicts = self.conflicts[rows][index].tolist()
+        warnings = warnings.T.tolist()
+        self.num_pairs += len(keys)
+        for key, conflict, warning in zip(keys, conflicts, warnings):
+            state = self.pairs.get(key)
+            if state is None or frame_id - state.last_frame > self.max_gap:
+                if state is not None:
+                    self.end_pair(state)
+                num_ctypes = len(self.ctypes)
+                state = pair_state(frame_id, [False]*num_ctypes, [None]*num_ctypes, [None]*num_ctypes, [False]*num_ctypes)
+                self.pairs[key] = state
+            state.last_frame = frame_id
+            for i in range(len(self.ctypes)):
+                if not warning[i]:
+                    state.warning_start[i] = None
+                elif state.warning_start[i] is None:
+                    state.warning_start[i] = frame_id
+                if conflict[i] and not state.in_conflict[i]:
+                    # a warning raised before the onset counts with a negative delay
+                    state.onset[i], state.warned[i] = frame_id, state.warning_start[i] is not None
+                    if state.warned[i]:
+                        self.delays.append((self.ctypes[i], (state.warning_start[i]-frame_id)*self.time_unit))
+                elif conflict[i] and not state.warned[i] and warning[i]:
+                    state.warned[i] = True
+                    self.delays.append((self.ctypes[i], (frame_id-state.onset[i])*self.time_unit))
+                elif not conflict[i] and state.in_conflict[i] and not state.warned[i]:
+                    self.delays.append((self.ctypes[i], np.nan))
+                state.in_conflict[i] = conflict[i]
+
+        # states not updated for longer than max_gap are dropped from time to time
+        if frame_id - self.last_pruned > self.max_gap:
+            for key in [key for key, state in self.pairs.items() if frame_id - state.last_frame > self.max_gap]:
+                self.end_pair(self.pairs.pop(key))
+            self.vehicles = {track_id:vehicle for track_id, vehicle in self.vehicles.items() if frame_id - vehicle[0] <= self.max_gap}
+            self.last_pruned = frame_id
+
+
+    def end_pair(self, state):
+        # conflicts that end without a warning are missed
+        for i in range(len(self.ctypes)):
+            if state.in_conflict[i] and not state.warned[i]:
+                self.delays.append((self.ctypes[i], np.nan))
+
+
+    def finish(self):
+        for state in self.pairs.values():
+            self.end_pair(state)
+        self.pairs = {}
+
+
+def replay_serial(streams):
+    for stream in tqdm(streams):
+        for frame_id, rows in stream.frames():
+            start = time.perf_counter()
+            result = stream.classify(frame_id, rows)
+            stream.latencies['classify'].append(time.perf_counter()-start)
+            stream.record(frame_id, rows, *result)
+        stream.finish()
+
+
+async def produce(stream, queue, start):
+    # frames are put in the queue when they would arrive from the sensor
+    first = None
+    for frame_id, rows in stream.frames():
+        first = frame_id if first is None else first
+        arrival = start + (frame_id-first)*stream.time_unit/speedup
+        await asyncio.sleep(max(arrival-time.perf_counter(), 0))
+        queue.put_nowait((arrival, frame_id, rows))
+    queue.put_nowait(None)
+
+
+async def consume(stream, queue):
+    # besides the time to classify a frame, as in the serial mode, the latency from its arrival includes the time waiting for the other streams
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        arrival, frame_id, rows = item
+        start = time.perf_counter()
+        result = stream.classify(frame_id, rows)
+        end = time.perf_counter()
+        stream.latencies['classify'].append(end-start)
+        stream.latencies['arrival'].append(end-arrival)
+        stream.record(frame_id, rows, *result)
+    stream.finish()
+
+
+async def replay_asyncio(streams):
+    start = time.perf_counter()
+    tasks = []
+    for stream in streams:
+        queue = asyncio.Queue()
+        tasks.extend([produce(stream, queue, start), consume(stream, queue)])
+    await asyncio.gather(*tasks)
+
+
+def summarise(loc, streams, detector):
+    # one row per span timed: 'classify' in both modes, and 'arrival' to classified in the asyncio mode
+    budget = 1000/(frame_rates[loc]*(speedup if mode == 'asyncio' else 1.))
+    latency = []
+    for span in ['classify', 'arrival'] if mode == 'asyncio' else ['classify']:
+        latencies = np.concatenate([stream.latencies[span] for stream in streams])*1000
+        latency.append([loc, mode, span, len(streams), len(latencies), sum([stream.num_pairs for stream in streams])]
+                       + np.percentile(latencies, percentiles).tolist() + [latencies.max(), budget, (latencies>budget).mean()])
+    latency = pd.DataFrame(latency, columns=['dataset','mode','span','num_streams','num_frames','num_pairs']
+                           +['p'+str(p)+'_ms' for p in percentiles]+['max_ms','budget_ms','over_budget'])
+
+    # delays from the onset of each conflict to its warning, nan for conflicts without warning
+    delays = pd.DataFrame([delay for stream in streams for delay in stream.delays], columns=['ctype','delay'])
+    warnings = []
+    for ctype in detector.ctypes:
+        delay = delays[delays['ctype']==ctype]['delay'].values
+        warned = delay[~np.isnan(delay)]
+        warnings.append([loc, ctype, alpha, len(delay), len(warned), (warned<=0).sum()]
+                        + (np.percentile(warned, percentiles).tolist() if len(warned) > 0 else [np.nan]*len(percentiles)))
+    warnings = pd.DataFrame(warnings, columns=['dataset','ctype','alpha','num_conflicts','num_warned','num_early']+['p'+str(p)+'_delay_s' for p in percentiles])
+    return latency, warnings
+
+
+def replay(loc, files):
+    detector = ConflictDetector(data_path + 'spacing/parameters_'+loc+'.csv')
+    with Profiling.stage(loc+' load') as record:
+        streams = [replay_stream(*stream, detector, time_units[loc]) for stream in load_streams(loc, files, list(detector.ctypes))]
+        record['num_streams'] = len(streams)
+    with Profiling.stage(loc+' replay', mode=mode, num_streams=len(streams)):
+        if mode == 'asyncio':
+            asyncio.run(replay_asyncio(streams))
+        else:
+            replay_serial(streams)
+    return summarise(loc, streams, detector)
+
+
+if __name__ == '__main__':
+    for loc, files in [('FreewayB', ['FreewayB_0'+str(i) for i in range(7,0,-1)]), ('100Car', ['HundredCar_CFData'])]:
+        latency, warnings = replay(loc, files)
+        latency.to_csv(data_path + 'replay_latency_'+loc+'.csv', index=False)
+        warnings.to_csv(data_path + 'replay_warnings_'+loc+'.csv', index=False)
+        print(latency.to_string(index=False))
+        print(warnings.to_string(index=False))
+
+    ## Report the run
+    Profiling.write_report('Replaying', alpha=alpha, mode=mode, speedup=speedup, max_gap=max_gap)
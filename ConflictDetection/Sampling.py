@@ -3,112 +3,364 @@ This file is used to determine conflicts and sample data for spacing inferences.
 '''
 
 import sys
+import os
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
+import Profiling
+import Storing
 
 # Define the directory of the project
 data_path = './localdata/'
 
+# Define settings
+freewayb_columns = ['position','speed','length','pre_position','pre_speed','pre_length']
+conflict_rules_file = data_path + 'conflict_rules.csv' # optional, to define more conflicts without editing the code
+streaming = False # process and group FreewayB one chunk at a time in float32/bool, so that memory is bounded by chunk_size and the few samples faster than the fastest full 0.1 m/s bin
+chunk_size = 10**6 # rows per chunk in the streaming mode
+
+
+# Define conflicts
+## Each rule marks a conflict when s <= coefficient * variable, for v in (v_lower, v_upper] and speed in (speed_lower, speed_upper].
+## The variable is 'v', 'speed' or 'constant'. More definitions can be added to conflict_rules.csv with the same columns.
+conflict_rules = pd.DataFrame([
+    ['conflict_1', 0, np.inf, -np.inf, np.inf, 'v', 3.],
+    ['conflict_2', 5, np.inf, -np.inf, np.inf, 'v', 2.5],
+    ['conflict_2', 2, 5, -np.inf, np.inf, 'v', 3.],
+    ['conflict_2', 0, 2, -np.inf, np.inf, 'v', 3.5],
+    ['conflict_3', 5, np.inf, -np.inf, np.inf, 'v', 2.5],
+    ['conflict_3', 2, 5, 25, np.inf, 'v', 3.5],
+    ['conflict_3', 2, 5, 10, 25, 'v', 3.],
+    ['conflict_3', 2, 5, -np.inf, 10, 'v', 2.5],
+    ['conflict_3', 0, 2, 5, np.inf, 'speed', 0.5],
+    ['conflict_3', 0, 2, 2, 5, 'speed', 0.3],
+    ['conflict_3', 0, 2, 1, 2, 'constant', 0.6],
+    ], columns=['ctype','v_lower','v_upper','speed_lower','speed_upper','variable','coefficient'])
+
 
 # Define functions
-def determine_conflicts(samples):
-    samples['conflict_1'] = False
-    relative_speed = (samples['v']>0)
-    samples.loc[relative_speed&(samples['s']<=(3*samples['v'])), 'conflict_1'] = True
-
-    samples['conflict_2'] = False
-    relative_speed = (samples['v']>5)
-    samples.loc[relative_speed&(samples['s']<=(2.5*samples['v'])), 'conflict_2'] = True
-    relative_speed = (samples['v']>2)&(samples['v']<=5)
-    samples.loc[relative_speed&(samples['s']<=(3*samples['v'])), 'conflict_2'] = True
-    relative_speed = (samples['v']>0)&(samples['v']<=2)
-    samples.loc[relative_speed&(samples['s']<=(3.5*samples['v'])), 'conflict_2'] = True
-
-    samples['conflict_3'] = False
-    relative_speed = (samples['v']>5)
-    samples.loc[relative_speed&(samples['s']<=(2.5*samples['v'])), 'conflict_3'] = True
-    relative_speed = (samples['v']>2)&(samples['v']<=5)
-    absolute_speed = (samples['speed']>25)
-    samples.loc[relative_speed&absolute_speed&(samples['s']<=(3.5*samples['v'])), 'conflict_3'] = True
-    absolute_speed = (samples['speed']>10)&(samples['speed']<=25)
-    samples.loc[relative_speed&absolute_speed&(samples['s']<=(3.*samples['v'])), 'conflict_3'] = True
-    absolute_speed = (samples['speed']<=10)
-    samples.loc[relative_speed&absolute_speed&(samples['s']<=(2.5*samples['v'])), 'conflict_3'] = True
-    relative_speed = (samples['v']>0)&(samples['v']<=2)
-    absolute_speed = (samples['speed']>5)
-    samples.loc[relative_speed&absolute_speed&(samples['s']<=(0.5*samples['speed'])), 'conflict_3'] = True
-    absolute_speed = (samples['speed']>2)&(samples['speed']<=5)
-    samples.loc[relative_speed&absolute_speed&(samples['s']<=(0.3*samples['speed'])), 'conflict_3'] = True
-    absolute_speed = (samples['speed']>1)&(samples['speed']<=2)
-    samples.loc[relative_speed&absolute_speed&(samples['s']<=0.6), 'conflict_3'] = True
+def register_conflicts(rules):
+    # later steps take the columns starting with 'conflict' as the conflict types, so other names would never be solved
+    unnamed = [ctype for ctype in rules['ctype'].unique() if not str(ctype).startswith('conflict')]
+    if len(unnamed) > 0:
+        raise ValueError("conflict types must start with 'conflict', got "+str(unnamed))
+    global conflict_rules
+    conflict_rules = pd.concat((conflict_rules[~conflict_rules['ctype'].isin(rules['ctype'])], rules)).reset_index(drop=True)
+    return conflict_rules
+
+
+def compile_rules(rules):
+    # split v and speed at every rule bound, so that each (v band, speed band) cell is either inside or outside a rule;
+    # the last band of each axis holds nan, which only rules without bounds on that axis cover
+    edges, band_lower, band_upper = [], [], []
+    for lower, upper in [('v_lower','v_upper'), ('speed_lower','speed_upper')]:
+        bounds = np.unique(rules[[lower, upper]].values.astype(float))
+        edges.append(bounds[np.isfinite(bounds)])
+        band_lower.append(np.concatenate(([-np.inf], edges[-1], [np.nan])))
+        band_upper.append(np.concatenate((edges[-1], [np.inf, np.nan])))
+
+    tables = {}
+    for ctype in rules['ctype'].unique():
+        variables, coefficients = [], []
+        for rule in rules[rules['ctype']==ctype].itertuples():
+            in_bands = []
+            for lower, upper, rule_lower, rule_upper in zip(band_lower, band_upper, [rule.v_lower, rule.speed_lower], [rule.v_upper, rule.speed_upper]):
+                in_band = (lower>=rule_lower)&(upper<=rule_upper)
+                in_band[-1] = (rule_lower==-np.inf)&(rule_upper==np.inf)
+                in_bands.append(in_band)
+            cells = (in_bands[0][:,np.newaxis]&in_bands[1][np.newaxis,:]).ravel()
+            # overlapping rules go to another layer, and layers are combined with or as successive assignments would be
+            layer = 0
+            while layer<len(variables) and (variables[layer][cells]>=0).any():
+                layer += 1
+            if layer==len(variables):
+                variables.append(np.full(len(cells), -1, dtype=np.int8))
+                coefficients.append(np.full(len(cells), -np.inf))
+            variables[layer][cells] = ['v','speed','constant'].index(rule.variable)
+            coefficients[layer][cells] = rule.coefficient
+        tables[ctype] = (variables, coefficients)
+
+    return edges, tables
+
+
+def determine_conflicts(samples, rules=None):
+    if rules is None:
+        rules = conflict_rules
+    edges, tables = compile_rules(rules)
+    s, v, speed = samples['s'].values, samples['v'].values, samples['speed'].values
+
+    # one interval lookup per sample gives its cell, shared by all conflict definitions
+    cell = np.searchsorted(edges[0], v, side='left')
+    cell[np.isnan(v)] = len(edges[0]) + 1
+    band = np.searchsorted(edges[1], speed, side='left')
+    band[np.isnan(speed)] = len(edges[1]) + 1
+    cell *= len(edges[1]) + 2
+    cell += band
+    band = []
+
+    for ctype, (variables, coefficients) in tables.items():
+        conflict = np.zeros(len(samples), dtype=bool)
+        for layer_variables, layer_coefficients in zip(variables, coefficients):
+            variable = layer_variables[cell]
+            limit = layer_coefficients[cell]
+            np.multiply(limit, v, out=limit, where=(variable==0))
+            np.multiply(limit, speed, out=limit, where=(variable==1))
+            conflict |= s <= limit
+        samples[ctype] = conflict
 
     return samples
 
 
-def Grouping(samples, vehnum):
+def load_outputdata(loc, columns):
+    if os.path.exists(data_path + 'outputdata/'+loc+'.parquet'):
+        return pd.read_parquet(data_path + 'outputdata/'+loc+'.parquet', columns=columns)
+    else:
+        return pd.read_hdf(data_path + 'outputdata/'+loc+'.h5', key='data')[columns]
+
+
+def iter_outputdata(loc, columns):
+    # chunks of chunk_size rows, read from row batches of Parquet files or row ranges of hdf files
+    path = data_path + 'outputdata/'+loc
+    if os.path.exists(path+'.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path+'.parquet').iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        with pd.HDFStore(path+'.h5', mode='r') as store:
+            num_rows = store.get_storer('data').shape[0]
+            for start in range(0, num_rows, chunk_size):
+                yield store.select('data', start=start, stop=start+chunk_size)[columns]
+
+
+def iter_samples(path, key, columns):
+    # chunks of chunk_size rows of samples appended by stream_samples
+    with pd.HDFStore(path, mode='r') as store:
+        num_rows = store.get_storer(key).nrows
+        for start in range(0, num_rows, chunk_size):
+            yield store.select(key, start=start, stop=start+chunk_size, columns=columns)
+
+
+def compact(samples):
+    return samples.astype({column:'float32' for column in samples.select_dtypes('float').columns})
+
+
+def freewayb_samples(data):
+    data['s'] = abs(data['pre_position'] - data['position']) - data['pre_length'] # net distance
+    data['v'] = data['speed'] - data['pre_speed']
+    return data[(data['s']>0)&(data['v']>0)].copy()
+
+
+def Grouping(samples, vehnum, mode='fixed', decimals=1):
+    # mode 'fixed': bins of 0.1 m/s up to the fastest one with at least vehnum samples, then consecutive chunks of vehnum samples;
+    # mode 'quantile': consecutive chunks of vehnum samples over the whole range, i.e. equal-count bins
     samples = samples.sort_values(by='v')
-    samples['round_v'] = np.round(samples.v,1)
-    groups = samples.groupby('round_v').v.count()
-    try:
-        threshold = groups[groups>=vehnum].index[-1]
-        sample1 = []
-        for roundv in samples[samples.round_v<=threshold].round_v.unique():
-            sample1.append(samples[samples.round_v==roundv])
-        sample1 = pd.concat(sample1)
-        print('--- '+str(roundv)+' ----')
-    except:
+    v = samples['v'].values
+    # round_v is kept in float64 also for float32 samples of the streaming mode
+    round_v = np.round(v.astype(float), 1)
+
+    if mode == 'fixed':
+        # round_v is sorted, so the sizes of the 0.1 m/s bins are the lengths of its runs
+        starts = np.concatenate(([0], np.flatnonzero(round_v[1:]!=round_v[:-1])+1))
+        counts = np.diff(np.append(starts, len(v)))
+        full = np.flatnonzero(counts>=vehnum)
+        if len(full) > 0:
+            threshold = round_v[starts[full[-1]]]
+            print('--- '+str(threshold)+' ----')
+        else:
+            threshold = 0
+            # samples rounded to 0 are left out, as when no bin was full before
+            samples = samples[round_v>0].copy()
+            v, round_v = v[round_v>0], round_v[round_v>0]
+        num_fixed = np.searchsorted(round_v, threshold, side='right')
+    elif mode == 'quantile':
+        num_fixed = 0
+    else:
+        raise ValueError("mode should be 'fixed' or 'quantile'")
+
+    round_v[num_fixed:] = chunk_means(v[num_fixed:], vehnum, decimals)
+    samples['round_v'] = round_v
+
+    bins = samples.groupby('round_v', sort=True)['v'].agg(['min','max','count']).reset_index()
+    bins = bins.rename(columns={'min':'v_min','max':'v_max'})
+
+    return samples, bins
+
+
+def chunk_means(v, vehnum, decimals):
+    # round_v of sorted speeds in consecutive chunks of vehnum, the rounded mean speed of each chunk
+    chunks = np.arange(0, len(v), vehnum)
+    chunk_counts = np.diff(np.append(chunks, len(v)))
+    means = np.add.reduceat(v, chunks, dtype=float)/chunk_counts if len(chunks)>0 else np.array([])
+    return np.repeat(np.round(means, decimals), chunk_counts)
+
+
+def speed_keys(v):
+    # round_v of the 0.1 m/s bins of Grouping, times 10
+    return np.round(v.astype(float)*10)
+
+
+def stream_bins(path, vehnum, decimals=1):
+    # Grouping in mode 'fixed' of the samples appended by stream_samples, in two passes of one chunk at a time: the counts of
+    # the 0.1 m/s bins give the fastest full one, and only the faster samples, fewer than vehnum per 0.1 m/s, are held to be
+    # split into chunks of vehnum; samples in the 0.1 m/s bins up to threshold are kept if any bin is full, as in Grouping
+    ## Count the samples of each 0.1 m/s bin
+    counts = pd.Series(dtype=float)
+    for samples in iter_samples(path, 'data', ['v']):
+        counts = counts.add(pd.Series(speed_keys(samples['v'].values)).value_counts(), fill_value=0)
+    counts = counts.sort_index()
+    full = counts.index[counts.values>=vehnum]
+    if len(full) > 0:
+        threshold = full[-1]
+        print('--- '+str(threshold/10)+' ----')
+    else:
+        # samples rounded to 0 are left out
         threshold = 0
-        sample1 = samples[samples.round_v<0].copy()
-    sample2 = samples[samples.round_v>threshold].copy()
-    sample2['round_v'] = np.arange(len(sample2))//vehnum
-    sample2['round_v'] = (np.round(sample2.groupby('round_v').v.mean(),1)).reindex(sample2.round_v).values
-    samples = pd.concat((sample1, sample2))
 
-    return samples
+    ## Speed ranges of the 0.1 m/s bins, and the faster speeds
+    fixed, tail = [], []
+    for samples in iter_samples(path, 'data', ['v']):
+        v = samples['v'].values
+        keys = speed_keys(v)
+        if len(full) > 0:
+            fixed.append(pd.DataFrame({'round_v':keys[keys<=threshold]/10, 'v':v[keys<=threshold]}).groupby('round_v')['v'].agg(['min','max','count']))
+        tail.append(v[keys>threshold])
+    tail = np.sort(np.concatenate(tail))
+    # equal speeds split between two chunks all go to the first, so that samples are assigned by their speed alone
+    round_v_tail = chunk_means(tail, vehnum, decimals)[np.searchsorted(tail, tail)]
+
+    bins = pd.concat(fixed + [pd.DataFrame({'round_v':round_v_tail, 'v':tail}).groupby('round_v')['v'].agg(['min','max','count'])])
+    bins = bins.groupby(level=0).agg({'min':'min', 'max':'max', 'count':'sum'}).reset_index()
+    bins = bins.rename(columns={'min':'v_min','max':'v_max'})
+    return bins, threshold, len(full) > 0, tail, round_v_tail
+
+
+def stream_toinfer(path, path_toinfer, columns, threshold, keep_fixed, tail, round_v_tail):
+    # samples to infer one chunk at a time, with the round_v of stream_bins, appended to path_toinfer as they are yielded
+    with pd.HDFStore(path_toinfer, mode='w') as store:
+        for samples in iter_samples(path, 'data', columns):
+            keys = speed_keys(samples['v'].values)
+            keep = (keys>threshold) | ((keys<=threshold) & keep_fixed)
+            samples, keys = samples[keep].reset_index(drop=True), keys[keep]
+            round_v = keys/10
+            round_v[keys>threshold] = round_v_tail[np.searchsorted(tail, samples['v'].values[keys>threshold])]
+            samples.insert(2, 'round_v', round_v)
+            store.append('samples', samples, index=False)
+            yield samples
+
+
+def apply_bins(v, bins):
+    # assign speeds to the bins of an earlier Grouping, splitting gaps between bins in the middle
+    bounds = (bins['v_max'].values[:-1] + bins['v_min'].values[1:])/2
+    return bins['round_v'].values[np.searchsorted(bounds, v, side='left')]
+
+
+def stream_samples(loc, files):
+    # as load_samples, one chunk at a time: conflicts are determined per chunk and the samples appended to samples_*.h5
+    ## Load data, determine conflicts and save one chunk at a time
+    num_samples, num_inf = 0, 0
+    with Profiling.stage(loc+' load and conflicts') as record, pd.HDFStore(data_path + 'samples/samples_'+loc+'.h5', mode='w') as store:
+        for file in tqdm(files):
+            for data in iter_outputdata(file, freewayb_columns):
+                samples = freewayb_samples(data)
+                data = []
+                samples['ttc'] = samples['s']/samples['v']
+                num_samples += len(samples)
+                num_inf += np.isinf(samples['ttc']).sum()
+                samples = determine_conflicts(samples)
+                store.append('data', compact(samples), index=False)
+        record['num_samples'] = num_samples
+    print('The percentage of TTCs that are inf: ', num_inf/num_samples)
+
+
+def load_samples(loc, files):
+    # synthetic conflicts are determined from the preprocessed trajectories
+    ## Load data
+    with Profiling.stage(loc+' load') as record:
+        data_all = []
+        for file in tqdm(files):
+            data = load_outputdata(file, freewayb_columns)
+            data_all.append(data)
+        data_all = pd.concat(data_all).reset_index(drop=True)
+        record['num_rows'] = len(data_all)
+
+        samples_loc = freewayb_samples(data_all)
+        data_all = []
+        record['num_samples'] = len(samples_loc)
+
+    ## Determine conflicts
+    with Profiling.stage(loc+' conflicts', num_samples=len(samples_loc)):
+        samples_loc['ttc'] = samples_loc['s']/samples_loc['v']
+        print('The percentage of TTCs that are inf: ', np.isinf(samples_loc['ttc']).sum()/len(samples_loc))
+        samples_loc = determine_conflicts(samples_loc)
+    samples_loc.to_hdf(data_path + 'samples/samples_'+loc+'.h5', key='data')
+    return samples_loc
+
+
+def load_empirical_samples(loc, files):
+    # real conflicts are marked in the conflict column of the car-following data
+    ## Load data
+    with Profiling.stage(loc+' load') as record:
+        data = pd.concat([pd.read_hdf(data_path + 'outputdata/'+file+'.h5', key='data') for file in files])
+        samples_loc = data[(data['s']>0)&(data['v']>0)].copy()
+        record.update({'num_rows':len(data), 'num_samples':len(samples_loc)})
+        data = []
+
+    ## Conflicts are empirical
+    samples_loc['ttc'] = samples_loc['s']/samples_loc['v']
+    print('The percentage of TTCs that are inf: ', np.isinf(samples_loc['ttc']).sum()/len(samples_loc))
+    samples_loc.to_hdf(data_path + 'samples/samples_'+loc+'.h5', key='data')
+    return samples_loc
+
 
+def sample_dataset(loc, files, vehnum, empirical=False):
+    # samples, speed bins and samples to infer of one dataset, from its files in outputdata
+    if streaming and not empirical:
+        stream_dataset(loc, files, vehnum)
+        return
+    samples_loc = load_empirical_samples(loc, files) if empirical else load_samples(loc, files)
+    ctype_list = ['conflict'] if empirical else list(conflict_rules['ctype'].unique())
 
-# FreewayB (synthetic conflicts)
+    ## Sample data
+    with Profiling.stage(loc+' grouping', num_samples=len(samples_loc)) as record:
+        samples, bins = Grouping(samples_loc, vehnum)
+        record['num_bins'] = len(bins)
+    bins.to_csv(data_path + 'samples/bins_'+loc+'.csv', index=False)
+    samples = samples.sort_values(by='v').reset_index(drop=True)
+    print('--- '+str(len(samples[samples.round_v<=10].round_v.unique()))+' ----')
+    samples = samples[['s','v','round_v']+ctype_list]
+    samples.to_hdf(data_path + 'samples/samples_toinfer_'+loc+'.h5', key='samples')
+    Storing.write_store(samples, Storing.store_path(loc))
 
-## Load data
-data_all = []
-for loc in tqdm(['FreewayB_0'+str(i) for i in range(7,0,-1)]):
-    data = pd.read_hdf(data_path + 'outputdata/'+loc+'.h5', key='data')
-    data_all.append(data)
-data_all = pd.concat(data_all).reset_index(drop=True)
 
-data_all['s'] = abs(data_all['pre_position'] - data_all['position']) - data_all['pre_length'] # net distance
-data_all['v'] = data_all['speed'] - data_all['pre_speed']
-samples_FreewayB = data_all[(data_all['s']>0)&(data_all['v']>0)].copy()
-data_all = []
+def stream_dataset(loc, files, vehnum):
+    # as sample_dataset, one chunk at a time, so that memory is bounded by chunk_size and the samples faster than the fastest
+    # full 0.1 m/s bin; within each bin, samples to infer are in the order of the files rather than sorted by v
+    stream_samples(loc, files)
+    ctype_list = list(conflict_rules['ctype'].unique())
+    path = data_path + 'samples/samples_'+loc+'.h5'
 
-## Determine conflicts
-samples_FreewayB['ttc'] = samples_FreewayB['s']/samples_FreewayB['v']
-print('The percentage of TTCs that are inf: ', np.isinf(samples_FreewayB['ttc']).sum()/len(samples_FreewayB))
-samples_FreewayB = determine_conflicts(samples_FreewayB)
-samples_FreewayB.to_hdf(data_path + 'samples/samples_FreewayB.h5', key='data')
+    ## Sample data
+    with Profiling.stage(loc+' grouping') as record:
+        bins, threshold, keep_fixed, tail, round_v_tail = stream_bins(path, vehnum)
+        record['num_bins'] = len(bins)
+    bins.to_csv(data_path + 'samples/bins_'+loc+'.csv', index=False)
+    print('--- '+str((bins['round_v']<=10).sum())+' ----')
+    with Profiling.stage(loc+' samples to infer', num_samples=int(bins['count'].sum())):
+        chunks = stream_toinfer(path, data_path + 'samples/samples_toinfer_'+loc+'.h5', ['s','v']+ctype_list, threshold, keep_fixed, tail, round_v_tail)
+        Storing.write_store_chunks(chunks, bins['round_v'].values, bins['count'].values.astype(int), Storing.store_path(loc))
 
-## Sample data
-samples = Grouping(samples_FreewayB, 7500)
-samples = samples.sort_values(by='v').reset_index(drop=True)
-print('--- '+str(len(samples[samples.round_v<=10].round_v.unique()))+' ----')
-samples[['s','v','round_v','conflict_1','conflict_2','conflict_3']].to_hdf(data_path + 'samples/samples_toinfer_FreewayB.h5', key='samples')
 
+# Add the conflicts defined in conflict_rules.csv
+if os.path.exists(conflict_rules_file):
+    register_conflicts(pd.read_csv(conflict_rules_file))
 
-# 100Car (real conflicts)
 
-## Load data
-data = pd.read_hdf(data_path + 'outputdata/HundredCar_CFData.h5', key='data')
-samples_100Car = data[(data['s']>0)&(data['v']>0)].copy()
-data = []
+if __name__ == '__main__':
+    # FreewayB (synthetic conflicts)
+    sample_dataset('FreewayB', ['FreewayB_0'+str(i) for i in range(7,0,-1)], 7500)
 
-## Conflicts are empirical
-samples_100Car['ttc'] = samples_100Car['s']/samples_100Car['v']
-print('The percentage of TTCs that are inf: ', np.isinf(samples_100Car['ttc']).sum()/len(samples_100Car))
-samples_100Car.to_hdf(data_path + 'samples/samples_100Car.h5', key='data')
+    # 100Car (real conflicts)
+    sample_dataset('100Car', ['HundredCar_CFData'], 1000, empirical=True)
 
-## Sample data
-samples = Grouping(samples_100Car, 1000)
-samples = samples.sort_values(by='v').reset_index(drop=True)
-print('--- '+str(len(samples[samples.round_v<=10].round_v.unique()))+' ----')
-samples[['s','v','round_v','conflict']].to_hdf(data_path + 'samples/samples_toinfer_100Car.h5', key='samples')
+    ## Report the run
+    Profiling.write_report('Sampling', streaming=streaming, chunk_size=chunk_size, conflict_types=list(conflict_rules['ctype'].unique()))
@@ -0,0 +1,116 @@
+'''
+This file is used to store the samples to infer sorted by round_v, as arrays that are memory-mapped rather than read,
+with the offset of each bin, so that the samples of a bin are a slice and processes opening the same store share its pages.
+'''
+
+# Import libraries
+import os
+import json
+import numpy as np
+
+# Define the directory of the project
+data_path = './localdata/'
+
+# Stores opened by this process
+stores = {} # path -> (modification time of the index, sample_store)
+
+
+# Define functions
+def store_path(loc):
+    # the arrays are saved as store_<loc>.<name>.npy next to samples_toinfer_<loc>.h5
+    return data_path + 'samples/store_'+loc
+
+
+def save_array(path, array):
+    # to a temporary file first, so that processes mapping the previous file keep reading it intact
+    with open(path+'.tmp', 'wb') as file:
+        np.save(file, array)
+    os.replace(path+'.tmp', path)
+
+
+def write_index(path, columns, roundvs, offsets):
+    # the index is written last, so that a store with an index is complete
+    save_array(path+'.round_v.npy', roundvs)
+    save_array(path+'.offsets.npy', offsets)
+    with open(path+'.index.json.tmp', 'w') as file:
+        json.dump({'columns':columns, 'num_samples':int(offsets[-1])}, file)
+    os.replace(path+'.index.json.tmp', path+'.index.json')
+
+
+def write_store(samples_toinfer, path):
+    # s, v and the conflict columns sorted by round_v, the round_v of each bin and the offset of its first sample
+    round_v = samples_toinfer['round_v'].values
+    order = np.argsort(round_v, kind='stable')
+    roundvs, counts = np.unique(round_v, return_counts=True)
+    columns = [column for column in samples_toinfer.columns if column != 'round_v']
+    for column in columns:
+        save_array(path+'.'+column+'.npy', samples_toinfer[column].values[order])
+    write_index(path, columns, roundvs, np.concatenate(([0], np.cumsum(counts))))
+
+
+def write_store_chunks(chunks, roundvs, counts, path):
+    # as write_store, from chunks of samples to infer given the round_v and size of every bin: the rows of each chunk are
+    # written to the next free rows of their bins in arrays mapped from the files, so that one chunk at a time is in memory
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    cursors = offsets[:-1].copy()
+    arrays = {}
+    for samples in chunks:
+        if len(arrays) == 0:
+            columns = [column for column in samples.columns if column != 'round_v']
+            for column in columns:
+                arrays[column] = np.lib.format.open_memmap(path+'.'+column+'.npy.tmp', mode='w+', dtype=samples[column].dtype, shape=(int(offsets[-1]),))
+        idx_bin = np.searchsorted(roundvs, samples['round_v'].values)
+        order = np.argsort(idx_bin, kind='stable')
+        sizes = np.bincount(idx_bin, minlength=len(roundvs))
+        rows = np.repeat(cursors - np.concatenate(([0], np.cumsum(sizes)[:-1])), sizes) + np.arange(len(order))
+        for column in columns:
+            arrays[column][rows] = samples[column].values[order]
+        cursors += sizes
+    for column in columns:
+        arrays[column].flush()
+        arrays[column] = []
+        os.replace(path+'.'+column+'.npy.tmp', path+'.'+column+'.npy')
+    write_index(path, columns, roundvs, offsets)
+
+
+def is_stale(path, source):
+    # a store is rewritten when it is missing or older than the samples it was written from
+    return not os.path.exists(path+'.index.json') or os.path.getmtime(path+'.index.json') < os.path.getmtime(source)
+
+
+class sample_store():
+    # opened by open_store, once per process and path, and sent to other processes as its path, where it is opened again
+    def __init__(self, path):
+        super().__init__()
+        with open(path+'.index.json') as file:
+            index = json.load(file)
+        self.path = path
+        self.columns = index['columns']
+        self.ctypes = [column for column in self.columns if column.startswith('conflict')]
+        self.roundvs = np.load(path+'.round_v.npy')
+        self.offsets = np.load(path+'.offsets.npy')
+        self.arrays = {column:np.load(path+'.'+column+'.npy', mmap_mode='r') for column in self.columns}
+
+
+    def __reduce__(self):
+        return open_store, (self.path,)
+
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+    def bin(self, roundv, column):
+        # the values of a column in the bin of roundv, without copying them; empty if there is no such bin
+        idx = np.searchsorted(self.roundvs, roundv)
+        if idx == len(self.roundvs) or self.roundvs[idx] != roundv:
+            return np.asarray(self.arrays[column][:0])
+        return np.asarray(self.arrays[column][self.offsets[idx]:self.offsets[idx+1]])
+
+
+def open_store(path):
+    # reopened when the store was rewritten since
+    mtime = os.path.getmtime(path+'.index.json')
+    if path not in stores or stores[path][0] != mtime:
+        stores[path] = (mtime, sample_store(path))
+    return stores[path][1]
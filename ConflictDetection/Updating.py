@@ -0,0 +1,240 @@
+'''
+This file is used to update the thresholds incrementally when new recordings arrive.
+'''
+
+# Import libraries
+import os
+import glob
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import Sampling
+import Computing
+
+# Define the directory of the project
+data_path = './localdata/'
+
+# Define settings
+s_limit = 500. # spacing (m) covered by the stored histograms, larger spacings are binned at the end of the grid
+verify_updates = True # rebuild the statistics from all recorded files in one pass and check the updated thresholds against them and Computing.py
+verify_tolerance = 0.5 # m, largest difference accepted between the updated thresholds and those of Computing.py on the same samples and bins
+
+
+# Define functions
+def list_files(loc):
+    # recordings are named as in outputdata, a new FreewayB clip or 100Car batch is picked up by the next run
+    pattern = 'FreewayB_*' if loc == 'FreewayB' else 'HundredCar_CFData*'
+    files = glob.glob(data_path + 'outputdata/' + pattern + '.h5') + glob.glob(data_path + 'outputdata/' + pattern + '.parquet')
+    return sorted(set([os.path.splitext(os.path.basename(file))[0] for file in files]))
+
+
+def file_samples(loc, file):
+    if loc == 'FreewayB':
+        samples = Sampling.freewayb_samples(Sampling.load_outputdata(file, Sampling.freewayb_columns))
+        samples = Sampling.determine_conflicts(samples)
+    else:
+        samples = pd.read_hdf(data_path + 'outputdata/' + file + '.h5', key='data')
+        samples = samples[(samples['s']>0)&(samples['v']>0)]
+    return samples
+
+
+def grid_size():
+    return int(np.round(s_limit/Computing.grid_step)) + 1
+
+
+def init_statistics(bins, ctype_list):
+    num_bins, size = len(bins), grid_size()
+    statistics = {'round_v':bins['round_v'].values, 'v_min':bins['v_min'].values, 'v_max':bins['v_max'].values,
+                  'files':np.array([], dtype=str), 'ctypes':np.array(ctype_list),
+                  'counts_s':np.zeros((num_bins, size)), 'moments_s':np.zeros((num_bins, 3))}
+    for ctype in ctype_list:
+        statistics['counts_sc_'+ctype] = np.zeros((num_bins, size))
+        statistics['moments_sc_'+ctype] = np.zeros((num_bins, 3))
+        statistics['smax_sc_'+ctype] = np.zeros(num_bins)
+        statistics['thresholds_'+ctype] = np.full((num_bins, 19, 6), np.nan)
+    return statistics
+
+
+def bin_statistics(s, idx_bin, num_bins):
+    # linearly binned counts on the grid from 0 to s_limit, and the size, mean and sum of squared deviations of each bin
+    size = grid_size()
+    position = np.clip(s, 0, s_limit)/Computing.grid_step
+    left = np.minimum(np.floor(position).astype(int), size-2)
+    fraction = position - left
+    left += idx_bin*size
+    counts = np.bincount(left, weights=1-fraction, minlength=num_bins*size)
+    counts += np.bincount(left+1, weights=fraction, minlength=num_bins*size)
+    num = np.bincount(idx_bin, minlength=num_bins).astype(float)
+    mean = np.bincount(idx_bin, weights=s, minlength=num_bins)/np.maximum(num, 1)
+    m2 = np.bincount(idx_bin, weights=(s-mean[idx_bin])**2, minlength=num_bins)
+    smax = np.zeros(num_bins)
+    np.maximum.at(smax, idx_bin, s)
+    return counts.reshape(num_bins, size), np.stack((num, mean, m2), axis=1), smax
+
+
+def merge_moments(moments_a, moments_b):
+    # pairwise combination of sizes, means and sums of squared deviations (Chan et al.)
+    num = moments_a[:,0] + moments_b[:,0]
+    delta = moments_b[:,1] - moments_a[:,1]
+    weight = np.divide(moments_b[:,0], num, out=np.zeros(len(num)), where=num>0)
+    mean = moments_a[:,1] + delta*weight
+    m2 = moments_a[:,2] + moments_b[:,2] + delta**2*moments_a[:,0]*weight
+    return np.stack((num, mean, m2), axis=1)
+
+
+def update_statistics(statistics, samples, file):
+    # speeds are assigned to the bins stored with the statistics, so that the bins do not move when data are added
+    bins = pd.DataFrame({name:statistics[name] for name in ['round_v','v_min','v_max']})
+    idx_bin = np.searchsorted(bins['round_v'].values, Sampling.apply_bins(samples['v'].values, bins))
+    s, num_bins = samples['s'].values.astype(float), len(bins)
+
+    counts, moments, smax = bin_statistics(s, idx_bin, num_bins)
+    statistics['counts_s'] += counts
+    statistics['moments_s'] = merge_moments(statistics['moments_s'], moments)
+    for ctype in statistics['ctypes']:
+        conflict = samples[ctype].values.astype(bool)
+        counts, moments, smax = bin_statistics(s[conflict], idx_bin[conflict], num_bins)
+        statistics['counts_sc_'+ctype] += counts
+        statistics['moments_sc_'+ctype] = merge_moments(statistics['moments_sc_'+ctype], moments)
+        statistics['smax_sc_'+ctype] = np.maximum(statistics['smax_sc_'+ctype], smax)
+    statistics['files'] = np.append(statistics['files'], file)
+    return statistics
+
+
+def bin_inputs(statistics, ctype):
+    # everything the thresholds of a bin depend on, as in spacing_samples_s and spacing_samples_sc:
+    # bins with too few conflicts borrow the conflicts of the nearest bin with enough, and the smallest conflict count
+    moments_s, moments_sc = statistics['moments_s'], statistics['moments_sc_'+ctype]
+    unempty = moments_sc[:,0] > 5
+    idx_unempty = np.flatnonzero(unempty)
+    if len(idx_unempty) == 0:
+        return None
+    idx_all = np.arange(len(unempty))
+    source = idx_unempty[np.argmin(np.abs(idx_unempty[np.newaxis,:]-idx_all[:,np.newaxis]), axis=1)]
+    num_sc = np.where(unempty, moments_sc[:,0], moments_sc[unempty,0].min())
+    c = np.divide(num_sc, moments_s[:,0], out=np.full(len(unempty), np.nan), where=moments_s[:,0]>0)
+    smax = np.where(unempty, statistics['smax_sc_'+ctype], 0.)
+    return np.column_stack((moments_s, source, moments_sc[source], c, smax))
+
+
+def solve_statistics(statistics, ctype, idx, inputs):
+    grid = np.arange(grid_size())*Computing.grid_step
+    moments_s, source, moments_sc, c, smax = inputs[idx,:3], int(inputs[idx,3]), inputs[idx,4:7], inputs[idx,7], inputs[idx,8]
+    if moments_s[0] <= 1:
+        return np.full((19,6), np.nan)
+    prob_s = Computing.binned_kde(bw_method=Computing.bw_method, grid_step=Computing.grid_step, grid=grid,
+                                  counts=statistics['counts_s'][idx], n=moments_s[0], variance=moments_s[2]/(moments_s[0]-1))
+    prob_sc = Computing.binned_kde(bw_method=Computing.bw_method, grid_step=Computing.grid_step, grid=grid,
+                                   counts=statistics['counts_sc_'+ctype][source], n=moments_sc[0], variance=moments_sc[2]/(moments_sc[0]-1))
+    return Computing.solve_threshold(prob_s, prob_sc, smax, c)
+
+
+def solve_changed(statistics, inputs_before, loc):
+    # only bins whose inputs changed are solved again, the thresholds of the others are kept
+    num_solved = 0
+    for ctype in statistics['ctypes']:
+        inputs = bin_inputs(statistics, ctype)
+        if inputs is None:
+            continue
+        thresholds = statistics['thresholds_'+ctype]
+        if inputs_before[ctype] is None:
+            changed = np.ones(len(inputs), dtype=bool)
+        else:
+            same = (inputs == inputs_before[ctype]) | (np.isnan(inputs) & np.isnan(inputs_before[ctype]))
+            changed = ~same.all(axis=1)
+        for idx in tqdm(np.flatnonzero(changed), desc=loc+' '+ctype):
+            thresholds[idx] = solve_statistics(statistics, ctype, idx, inputs)
+        num_solved += changed.sum()
+    return num_solved
+
+
+def statistics_to_parameters(statistics):
+    parameters = []
+    for ctype in statistics['ctypes']:
+        parameters_ctype = Computing.thresholds_to_parameters(statistics['round_v'], list(statistics['thresholds_'+ctype]))
+        parameters_ctype['ctype'] = ctype
+        parameters.append(parameters_ctype)
+    return pd.concat(parameters).reset_index(drop=True)
+
+
+def load_statistics(loc):
+    path = data_path + 'spacing/statistics_'+loc+'.npz'
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as entry:
+        return {name:entry[name] for name in entry.files}
+
+
+def save_statistics(statistics, loc):
+    path = data_path + 'spacing/statistics_'+loc+'.npz'
+    # write to a temporary file first, so that an interrupted run leaves the previous statistics intact
+    temporary = path[:-len('.npz')] + '.tmp.npz'
+    np.savez_compressed(temporary, **statistics)
+    os.replace(temporary, path)
+
+
+def conflict_types(loc):
+    return list(Sampling.conflict_rules['ctype'].unique()) if loc == 'FreewayB' else ['conflict']
+
+
+def update(loc, files, statistics=None):
+    if statistics is None:
+        # the first run starts from the bins of Sampling.py
+        statistics = init_statistics(pd.read_csv(data_path + 'samples/bins_'+loc+'.csv'), conflict_types(loc))
+    elif list(statistics['ctypes']) != conflict_types(loc):
+        raise ValueError('The conflict types differ from those of the stored statistics, remove statistics_'+loc+'.npz to rebuild them')
+
+    new_files = [file for file in files if file not in statistics['files']]
+    inputs_before = {ctype:bin_inputs(statistics, ctype) for ctype in statistics['ctypes']}
+    for file in tqdm(new_files, desc=loc):
+        statistics = update_statistics(statistics, file_samples(loc, file), file)
+    num_solved = solve_changed(statistics, inputs_before, loc) if len(new_files) > 0 else 0
+    return statistics, new_files, num_solved
+
+
+def verify(loc, statistics):
+    # a from-scratch run over the same files, with all of their samples added at once
+    samples = pd.concat([file_samples(loc, file) for file in statistics['files']]).reset_index(drop=True)
+    bins = pd.DataFrame({name:statistics[name] for name in ['round_v','v_min','v_max']})
+    ctype_list = list(statistics['ctypes'])
+    scratch = init_statistics(bins, ctype_list)
+    scratch = update_statistics(scratch, samples, 'all')
+    solve_changed(scratch, {ctype:None for ctype in scratch['ctypes']}, loc+' (from scratch)')
+
+    parameters, parameters_scratch = statistics_to_parameters(statistics), statistics_to_parameters(scratch)
+    same_thresholds = np.array_equal(parameters['threshold'].values, parameters_scratch['threshold'].values, equal_nan=True)
+    columns = ['smax','cum_smax_s','cum_smax_sc','c']
+    max_difference = np.nanmax(np.abs(parameters[columns].values - parameters_scratch[columns].values))
+    print(loc+': thresholds '+('match' if same_thresholds else 'do not match')+' the from-scratch run, '
+          +'the largest difference in '+', '.join(columns)+' is '+str(max_difference))
+
+    # Computing.py on the same samples, assigned to the same bins; its densities are fitted on a grid around the samples
+    # of each bin (or exactly with the 'scipy' backend) rather than on the histograms from 0 to s_limit, so that the
+    # thresholds agree within verify_tolerance rather than exactly
+    samples['round_v'] = Sampling.apply_bins(samples['v'].values, bins)
+    roundvs = np.sort(samples['round_v'].unique())
+    reference = Computing.compute_thresholds_bins(samples[['s','v','round_v']+ctype_list], roundvs, ctype_list, loc+' (Computing.py)')
+    for parameters_ctype, ctype in zip(reference, ctype_list):
+        parameters_ctype['ctype'] = ctype
+    compared = parameters.merge(pd.concat(reference), on=['ctype','round_v','alpha'], suffixes=('','_computing'))
+    difference = np.abs(compared['threshold'] - compared['threshold_computing']).values
+    both_nan = compared[['threshold','threshold_computing']].isna().all(axis=1).values
+    within_tolerance = ((difference <= verify_tolerance) | both_nan).all()
+    print(loc+': thresholds are '+('within' if within_tolerance else 'not within')+' '+str(verify_tolerance)+' m of Computing.py, '
+          +'the largest difference is '+str(np.nanmax(difference))+' m')
+    return same_thresholds and within_tolerance
+
+
+if __name__ == '__main__':
+    for loc in ['FreewayB', '100Car']:
+        statistics = load_statistics(loc)
+        statistics, new_files, num_solved = update(loc, list_files(loc), statistics)
+        if len(new_files) == 0:
+            print(loc+': no new files')
+            continue
+        print(loc+': added '+', '.join(new_files)+', '+str(num_solved)+' (conflict type, round_v) thresholds recomputed')
+        save_statistics(statistics, loc)
+        statistics_to_parameters(statistics).to_csv(data_path + 'spacing/parameters_incremental_'+loc+'.csv', index=False)
+
+        if verify_updates:
+            verify(loc, statistics)
@@ -0,0 +1,222 @@
+'''
+This file is used to run preprocessing, sampling and computing as a graph of tasks per dataset and per file,
+skipping the tasks whose inputs, code and arguments are unchanged since their last successful run.
+'''
+
+# Import libraries
+# only the standard library, the modules of the tasks (and numpy, pandas, scipy with them) are imported by the processes running them
+import os
+import sys
+import re
+import glob
+import json
+import hashlib
+import importlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Define the directory of the project
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+module_paths = [os.path.join(repo_path, 'Pre-processing'), os.path.join(repo_path, 'ConflictDetection')]
+config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datasets.json')
+data_path = './localdata/'
+
+# Define settings
+num_workers = 4 # tasks run in parallel, each in a new process
+state_file = data_path + 'pipeline_state.json' # signatures of the last successful run of each task
+
+
+# Define functions
+def load_config(path=config_file):
+    with open(path) as file:
+        return json.load(file)
+
+
+def file_capture(pattern, path):
+    # the part of path matched by the * of pattern, e.g. 01 for FreewayB-01.csv and FreewayB-*.csv
+    regex = '(.*)'.join([re.escape(part) for part in pattern.split('*', 1)])
+    return re.fullmatch(regex, path).group(1)
+
+
+def make_task(name, module, function, args, inputs, outputs, deps):
+    # inputs are glob patterns, outputs are paths without extension, as files are saved in hdf or Parquet
+    return {'name':name, 'module':module, 'function':function, 'args':args, 'inputs':inputs, 'outputs':outputs, 'deps':deps}
+
+
+def build_tasks(config):
+    # per dataset, preprocess each raw file or the whole dataset -> sample -> compute;
+    # tasks are listed after the tasks they depend on
+    tasks = []
+    for loc, dataset in config.items():
+        preprocess = dataset['preprocess']
+        preprocess_tasks = []
+        if 'per_file' in preprocess:
+            for path in sorted(glob.glob(data_path + preprocess['per_file'])):
+                capture = file_capture(data_path + preprocess['per_file'], path)
+                outputs = [data_path + output.format(capture) for output in preprocess['outputs']]
+                preprocess_tasks.append(make_task('preprocess:'+loc+':'+capture, preprocess['module'], preprocess['function'],
+                                                  [path], [path], outputs, []))
+        else:
+            inputs = [data_path + pattern for pattern in preprocess['inputs']]
+            outputs = [data_path + output for output in preprocess['outputs']]
+            preprocess_tasks.append(make_task('preprocess:'+loc, preprocess['module'], preprocess['function'], [], inputs, outputs, []))
+        tasks.extend(preprocess_tasks)
+
+        # files in outputdata are sampled in reverse order, as in Sampling.py
+        outputdata = sorted([output for task in preprocess_tasks for output in task['outputs'] if output.startswith(data_path + 'outputdata/')], reverse=True)
+        sample = dataset['sample']
+        inputs = [output + '.*' for output in outputdata] + ([] if sample['empirical'] else [data_path + 'conflict_rules.csv'])
+        outputs = [data_path + 'samples/' + name + '_' + loc for name in ['samples', 'samples_toinfer', 'store', 'bins']]
+        tasks.append(make_task('sample:'+loc, 'Sampling', 'sample_dataset', [loc, [os.path.basename(output) for output in outputdata], sample['vehnum'], sample['empirical']],
+                               inputs, outputs, [task['name'] for task in preprocess_tasks]))
+
+        inputs = [output + '.*' for output in outputs[:3]]
+        outputs = [data_path + 'spacing/' + name + '_' + loc for name in ['parameters', 'frontiers']]
+        tasks.append(make_task('compute:'+loc, 'Computing', 'compute_dataset', [loc], inputs, outputs, ['sample:'+loc]))
+    return tasks
+
+
+def select_tasks(tasks, targets):
+    # the tasks named by targets, with the tasks they depend on; a target is a stage (compute), a dataset (FreewayB),
+    # or the start of task names (sample:100Car, preprocess:FreewayB:01)
+    if len(targets) == 0:
+        return tasks
+    by_name = {task['name']:task for task in tasks}
+    matched = []
+    for target in targets:
+        names = [name for name in by_name if (name+':').startswith(target+':') or target == name.split(':')[1]]
+        if len(names) == 0:
+            raise ValueError('No task matches '+target+', the tasks are '+', '.join(by_name))
+        matched.extend(names)
+    selected = set()
+    while len(matched) > 0:
+        name = matched.pop()
+        if name not in selected:
+            selected.add(name)
+            matched.extend(by_name[name]['deps'])
+    return [task for task in tasks if task['name'] in selected]
+
+
+def source_files(module, found=None):
+    # the file of a module and of the modules of this project it imports, whose settings and code the outputs depend on
+    found = [] if found is None else found
+    for directory in module_paths:
+        path = os.path.join(directory, module + '.py')
+        if os.path.exists(path) and path not in found:
+            found.append(path)
+            with open(path) as file:
+                for imported in re.findall(r'^\s*(?:import|from)\s+(\w+)', file.read(), flags=re.MULTILINE):
+                    source_files(imported, found)
+    return found
+
+
+def files_state(patterns):
+    # size and modification time of the files matching each pattern, which change whenever a file is rewritten
+    state = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            stat = os.stat(path)
+            state.append([path, stat.st_size, stat.st_mtime_ns])
+    return state
+
+
+def signature(task):
+    code = []
+    for path in source_files(task['module']):
+        with open(path, 'rb') as file:
+            code.append(hashlib.sha256(file.read()).hexdigest())
+    content = {'function':task['module']+'.'+task['function'], 'args':task['args'], 'inputs':files_state(task['inputs']), 'code':code}
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+def outputs_state(task):
+    return files_state([output + '.*' for output in task['outputs']])
+
+
+def is_fresh(task, state):
+    # a task is fresh if it ran with the same signature and its outputs exist unchanged since
+    entry = state.get(task['name'])
+    if entry is None or not all([len(glob.glob(output + '.*')) > 0 for output in task['outputs']]):
+        return False
+    return entry['signature'] == signature(task) and entry['outputs'] == outputs_state(task)
+
+
+def load_state():
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as file:
+        return json.load(file)
+
+
+def save_state(state):
+    # write to a temporary file first, so that an interrupted run leaves the previous state intact
+    temporary = state_file + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(temporary, state_file)
+
+
+def plan(tasks, force=False):
+    # 'fresh', 'stale', or 'stale (upstream)' when a task it depends on is going to run
+    state, status = load_state(), {}
+    for task in tasks:
+        if any([status[dep] != 'fresh' for dep in task['deps'] if dep in status]):
+            status[task['name']] = 'stale (upstream)'
+        elif force or not is_fresh(task, state):
+            status[task['name']] = 'stale'
+        else:
+            status[task['name']] = 'fresh'
+    return status
+
+
+def run_task(task):
+    # in a new process, so that the settings and records of one task do not leak into another
+    sys.path.extend([path for path in module_paths if path not in sys.path])
+    for output in task['outputs']:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    module = importlib.import_module(task['module'])
+    getattr(module, task['function'])(*task['args'])
+    if 'Profiling' in sys.modules:
+        sys.modules['Profiling'].write_report(task['name'].replace(':', '_'))
+
+
+def run(tasks, num_workers=num_workers, force=False):
+    # tasks start as soon as the tasks they depend on are done, and tasks downstream of a failed task are not run
+    state = load_state()
+    by_name = {task['name']:task for task in tasks}
+    done, failed, running = set(), set(), {}
+    ran, skipped = [], []
+    with ProcessPoolExecutor(max_workers=num_workers, max_tasks_per_child=1) as executor:
+        while True:
+            for task in tasks:
+                name = task['name']
+                if name in done or name in failed or name in running.values():
+                    continue
+                if any([dep in failed for dep in task['deps']]):
+                    failed.add(name)
+                    print(name+': not run, a task it depends on failed')
+                elif all([dep in done for dep in task['deps'] if dep in by_name]):
+                    if not force and is_fresh(task, state):
+                        done.add(name)
+                        skipped.append(name)
+                        print(name+': up to date')
+                    else:
+                        running[executor.submit(run_task, task)] = name
+                        print(name+': running')
+            if len(running) == 0:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    failed.add(name)
+                    print(name+': failed, '+repr(error))
+                    continue
+                state[name] = {'signature':signature(by_name[name]), 'outputs':outputs_state(by_name[name])}
+                save_state(state)
+                done.add(name)
+                ran.append(name)
+                print(name+': done')
+    return ran, skipped, [task['name'] for task in tasks if task['name'] in failed]
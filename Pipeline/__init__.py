@@ -0,0 +1,5 @@
+'''
+This package is used to run the pipeline as a graph of tasks, see Orchestrating.py, or python -m Pipeline --help.
+'''
+
+from .Orchestrating import load_config, build_tasks, select_tasks, plan, run
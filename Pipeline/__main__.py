@@ -0,0 +1,44 @@
+'''
+This file is used to run the pipeline from the command line, e.g. python -m Pipeline compute:100Car --jobs 4
+'''
+
+# Import libraries
+import os
+import sys
+import argparse
+if __package__ in (None, ''):
+    # run as python Pipeline from the project directory
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Pipeline import Orchestrating
+
+
+# Define functions
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m Pipeline', description='Run preprocessing, sampling and computing, skipping the tasks that are up to date.')
+    parser.add_argument('targets', nargs='*', help='tasks to run with the tasks they depend on, e.g. compute, FreewayB, sample:100Car or preprocess:FreewayB:01; all tasks if none')
+    parser.add_argument('--root', default='.', help='directory containing localdata/, the current directory by default')
+    parser.add_argument('--config', default=Orchestrating.config_file, help='json file defining the datasets')
+    parser.add_argument('--jobs', type=int, default=Orchestrating.num_workers, help='tasks run in parallel')
+    parser.add_argument('--force', action='store_true', help='run the selected tasks even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='list the selected tasks and whether they are up to date, without running them')
+    args = parser.parse_args(argv)
+
+    config = Orchestrating.load_config(os.path.abspath(args.config))
+    os.chdir(args.root)
+    try:
+        tasks = Orchestrating.select_tasks(Orchestrating.build_tasks(config), args.targets)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.dry_run:
+        for name, status in Orchestrating.plan(tasks, args.force).items():
+            print(name+': '+status)
+        return 0
+
+    ran, skipped, failed = Orchestrating.run(tasks, args.jobs, args.force)
+    print(str(len(ran))+' tasks run, '+str(len(skipped))+' up to date, '+str(len(failed))+' failed'+(': '+', '.join(failed) if len(failed) > 0 else ''))
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,7 @@ This file is used to preprocess the Freeway B dataset.
 import pandas as pd
 import numpy as np
 import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
 # Define the directory of the project
@@ -13,11 +14,81 @@ path_rawdata = './localdata/rawdata/'
 path_inputdata = './localdata/inputdata/FreewayB/'
 path_outputdata = './localdata/outputdata/'
 
-
-# Preprocessing
-data_files = glob.glob(path_rawdata + '*.csv')
-for data_file in data_files:
-    data = pd.read_csv(data_file)
+# Define settings
+num_workers = 4 # number of files preprocessed in parallel, 1 to run sequentially
+output_format = 'hdf' # 'hdf', or 'parquet' (requires pyarrow) to allow loading selected columns
+raw_dtypes = {'frameNum':'int32', 'carId':'int32', 'speed':'float32', 'laneId':'int8',
+              'boundingBox1Xft':'float32', 'boundingBox1Yft':'float32', 'boundingBox2Xft':'float32', 'boundingBox2Yft':'float32',
+              'boundingBox3Xft':'float32', 'boundingBox3Yft':'float32', 'boundingBox4Xft':'float32', 'boundingBox4Yft':'float32'}
+
+
+# Define functions
+def assign_preceding(data):
+    # sort once so that vehicles in the same frame and lane are contiguous and ordered by headXft
+    order = np.lexsort((data['headXft'].values, data['laneId'].values, data['frame_id'].values))
+    frame = data['frame_id'].values[order]
+    lane = data['laneId'].values[order]
+    headx = data['headXft'].values[order]
+    track = data['track_id'].values[order]
+
+    num_rows = len(order)
+    positions = np.arange(num_rows)
+    new_group = np.ones(num_rows, dtype=bool)
+    new_group[1:] = (frame[1:]!=frame[:-1])|(lane[1:]!=lane[:-1])
+    new_value = new_group.copy()
+    new_value[1:] |= (headx[1:]!=headx[:-1])
+    group_id = np.cumsum(new_group) - 1
+    # first and last row sharing the same headXft within the group, so that the search is strict
+    value_start = np.maximum.accumulate(np.where(new_value, positions, 0))
+    value_end = np.flip(np.minimum.accumulate(np.flip(np.where(np.append(new_value[1:], True), positions, num_rows))))
+
+    # lanes 1-2 drive towards decreasing x, lanes 3-4 towards increasing x
+    backward = lane<2.5
+    forward = lane>2.5
+    candidate = np.where(backward, value_start-1, value_end+1)
+    step = np.where(backward, -1, 1)
+    valid = (backward|forward)&(candidate>=0)&(candidate<num_rows)
+    valid[valid] = group_id[candidate[valid]]==group_id[valid]
+    # skip duplicated records of the vehicle itself
+    rows = np.flatnonzero(valid)
+    rows = rows[track[candidate[rows]]==track[rows]]
+    while len(rows)>0:
+        candidate[rows] += step[rows]
+        inside = (candidate[rows]>=0)&(candidate[rows]<num_rows)
+        inside[inside] = group_id[candidate[rows[inside]]]==group_id[rows[inside]]
+        valid[rows[~inside]] = False
+        rows = rows[inside]
+        rows = rows[track[candidate[rows]]==track[rows]]
+
+    preceding = np.full(num_rows, np.nan)
+    preceding[valid] = track[candidate[valid]]
+    preceding_id = np.empty(num_rows)
+    preceding_id[order] = preceding
+    return preceding_id
+
+
+def reconstruct_position(data):
+    # average of integrating the speed forward from the first and backward from the last x of each track,
+    # data should be sorted by track_id and frame_id; the sums run in float64, as float32 sums over long tracks drift
+    speed = data['speed'].astype(float)
+    tracks = data.groupby('track_id', sort=False)
+    x_first = tracks['x'].transform('first').astype(float)
+    x_last = tracks['x'].transform('last').astype(float)
+    direction = np.sign(x_last - x_first)
+    forward = speed.groupby(data['track_id'], sort=False).cumsum()
+    backward = speed.iloc[::-1].groupby(data['track_id'].iloc[::-1], sort=False).cumsum().iloc[::-1]
+    return (((x_first + direction*forward/30) + (x_last - direction*backward/30))/2).values
+
+
+def save_data(data, path):
+    if output_format == 'parquet':
+        data.reset_index(drop=True).to_parquet(path + '.parquet', index=False)
+    else:
+        data.to_hdf(path + '.h5', key='data')
+
+
+def preprocess_file(data_file):
+    data = pd.read_csv(data_file, usecols=list(raw_dtypes.keys()), dtype=raw_dtypes)
     suffix = int(data_file[-6:-4])
     data['suffix'] = suffix
     data['frameNum'] = (suffix*100000 + data['frameNum']).astype(int)
@@ -34,48 +105,25 @@ for data_file in data_files:
     data = data.rename(columns={'frameNum':'frame_id','carId':'track_id'})
 
     # preceding vehicle
-    for idx in tqdm(data.index, total=len(data), desc=data_file[-5:-3]):
-        alternatives = data[(data['frame_id']==data.frame_id.loc[idx])&
-                            (data['laneId']==data.laneId.loc[idx])&
-                            (data['track_id']!=data.track_id.loc[idx])]
-        if data.laneId.loc[idx]<2.5:
-            preceding = alternatives[alternatives.headXft<data.headXft.loc[idx]].sort_values(by='headXft', ascending=False)
-            if len(preceding)>0:
-                preceding = preceding.iloc[0]
-                data.loc[idx, 'precedingId'] = preceding['track_id']
-        elif data.laneId.loc[idx]>2.5:
-            preceding = alternatives[alternatives.headXft>data.headXft.loc[idx]].sort_values(by='headXft', ascending=True)
-            if len(preceding)>0:
-                preceding = preceding.iloc[0]
-                data.loc[idx, 'precedingId'] = preceding['track_id']
+    data['precedingId'] = assign_preceding(data)
 
     data = data[['track_id','frame_id','headXft','headYft','length','speed','laneId','precedingId']]
     distance = ['headXft','headYft','length']
     data[distance] = data[distance]/3.281 # Feet to meters
     data['speed'] = data['speed']/2.237 # Miles/hour to m/s
 
-    data.to_hdf(path_inputdata + 'FreewayB_'+data_file[-6:-4]+'.h5', key='data')
+    save_data(data, path_inputdata + 'FreewayB_'+data_file[-6:-4])
 
     # position based on speed
     data = data.drop_duplicates(['track_id','frame_id'])
     data = data.rename(columns={'headXft':'x','headYft':'y'})
-    data = data.sort_values(['track_id','frame_id']).set_index('track_id')
-    for trackid in tqdm(data.index.unique()):
-        track = data.loc[trackid]
-        if len(track.shape)==1:
-            data.loc[trackid,'position'] = track['x']
-        else:
-            track = track.reset_index()
-            direction = np.sign(track['x'].iloc[-1]-track['x'].iloc[0])
-            data.loc[trackid,'position'] = (((track['x'].iloc[0]+direction*track['speed'].cumsum()/30)+
-                                            (track['x'].iloc[-1]-direction*track['speed'].iloc[-1::-1].cumsum()/30))/2).values
-
-    data = data.reset_index()
+    data = data.sort_values(['track_id','frame_id']).reset_index(drop=True)
+    data['position'] = reconstruct_position(data)
 
     # check if a preceding vehicle has more than one following vehicle
     num_following = data.groupby(['frame_id','precedingId'])['track_id'].count().reset_index().rename(columns={'track_id':'num_following'})
     num_following = num_following[num_following['num_following']>1]
-    print('There are '+str(len(num_following['precedingId'].unique()))+' preceding vehicles with more than one following vehicle.')
+    message = 'There are '+str(len(num_following['precedingId'].unique()))+' preceding vehicles with more than one following vehicle.'
     data = data[~data['precedingId'].isin(num_following['precedingId'].unique())]
 
     data[['pre_position','pre_speed','pre_length']] = data.set_index(['frame_id','track_id']).reindex(pd.MultiIndex.from_arrays(data[['frame_id','precedingId']].values.T, names=('frame_id', 'precedingId')))[['position','speed','length']].values
@@ -90,7 +138,26 @@ for data_file in data_files:
 
     data = data[['laneId','frame_id','track_id','position','speed','length','precedingId','pre_position','pre_speed','pre_length']]
     data[['laneId','frame_id','track_id','precedingId']] = data[['laneId','frame_id','track_id','precedingId']].astype(int)
-    data.to_hdf(path_outputdata + 'FreewayB_'+data_file[-6:-4]+'.h5', key='data')
+    save_data(data, path_outputdata + 'FreewayB_'+data_file[-6:-4])
 
+    return message
 
-print('FreewayB preprocessing done!')
+
+# Preprocessing
+if __name__ == '__main__':
+    data_files = sorted(glob.glob(path_rawdata + '*.csv'))
+    failed_files = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(preprocess_file, data_file): data_file for data_file in data_files}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            data_file = futures[future]
+            try:
+                tqdm.write(data_file[-6:-4] + ': ' + future.result())
+            except Exception as error:
+                failed_files.append(data_file)
+                tqdm.write(data_file[-6:-4] + ' failed: ' + repr(error))
+
+    if len(failed_files)>0:
+        print('FreewayB preprocessing failed for '+str(len(failed_files))+' files: '+', '.join(failed_files))
+    else:
+        print('FreewayB preprocessing done!')
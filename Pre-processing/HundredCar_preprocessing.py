@@ -4,7 +4,6 @@ This file is used to preprocess the HundredCar dataset.
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 path_output = './localdata/outputdata/'
 path_input = './localdata/inputdata/100Car/'
@@ -28,73 +27,69 @@ class cf_extractor():
         return data
 
 
-    # Organize data
+    # Organize data of all trips at once
     def organise_data(self,):
-        cfdata = []
-
-        for trip_id in tqdm(self.trip_ids):
-            df_ego = self.data_ego.loc[trip_id].reset_index()
-            df_sur = self.data_sur.loc[trip_id]
-            merged = df_ego.merge(df_sur, on='time', suffixes=('_ego', '_sur'))
-            forward = merged[merged['forward'].astype(bool)].groupby('time')['range'].idxmin()
-            forward = merged.loc[forward][['time','target_id']]
-            rearward = merged[~merged['forward'].astype(bool)].groupby('time')['range'].idxmin()
-            rearward = merged.loc[rearward][['time','target_id']]
-
-            merged = merged.set_index('target_id')
-            # For forward conflicts
-            unique_forward = forward['target_id'].unique()
-            unique_rearward = rearward['target_id'].unique()
-            if ('lead' in self.meta.loc[trip_id]['target']) and (len(unique_forward)==1):
-                df = merged.loc[unique_forward[0]].reset_index()
-                if len(df[df['event'].astype(bool)])>10: # focus on the exact moment of conflict
-                    tenth_range = df[df['event'].astype(bool)]['range'].sort_values().iloc[10]
-                    df.loc[df['range']>tenth_range, 'event'] = 0
-                df['frame_id'] = (df['time']*100).astype(int)
-                df['s'] = np.sqrt((df['x_ego']-df['x_sur'])**2 + (df['y_ego']-df['y_sur'])**2)
-                df['v'] = df['speed_ego'] - df['speed_sur']
-                df['speed'] = df['speed_ego']
-            # For rearward conflicts
-            elif ('follow' in self.meta.loc[trip_id]['target']) and (len(unique_rearward)==1):
-                df = merged.loc[unique_rearward[0]].reset_index()
-                if len(df[df['event'].astype(bool)])>10:
-                    tenth_range = df[df['event'].astype(bool)]['range'].sort_values().iloc[10]
-                    df.loc[df['range']>tenth_range, 'event'] = 0
-                df['frame_id'] = (df['time']*100).astype(int)
-                df['s'] = np.sqrt((df['x_ego']-df['x_sur'])**2 + (df['y_ego']-df['y_sur'])**2)
-                df['v'] = df['speed_sur'] - df['speed_ego']
-                df['speed'] = df['speed_sur']
-            else:
-                continue
-
-            if len(df)>0:
-                cfdata.append(df[['trip_id','frame_id','s','v','speed','event']].rename(columns={'trip_id':'track_id','event':'conflict'}))
-        
-        return pd.concat(cfdata).reset_index(drop=True)
-
-
-# Load data
-print('Loading data...')
-cfdata = []
-for conflict_type in ['Crash', 'NearCrash']:
-    data_ego = pd.read_hdf(path_input + 'HundredCar_'+conflict_type+'_Ego.h5', key='data')
-    data_sur = pd.read_hdf(path_input + 'HundredCar_'+conflict_type+'_Surrounding.h5', key='data')
-    data_sur = data_sur.drop(columns=['x','y'])
-    meta = pd.read_csv(path_input + 'HundredCar_metadata_'+conflict_type+'Event.csv').set_index('webfileid')
-    meta = meta.loc[(data_ego['trip_id'].unique())]
-
-    counted_target = ['lead vehicle','following vehicle']
-    meta = meta[meta['target'].isin(counted_target)] # remain car-following scenarios only
-
-    data_ego = data_ego[data_ego['trip_id'].isin(meta.index)]
-    data_sur = data_sur[data_sur['trip_id'].isin(meta.index)]
-    print(f'There are {data_ego['trip_id'].nunique()} trips for car-following extraction\n')
-
-    # Extract car-following conflict data and save
-    cfe = cf_extractor([data_ego, data_sur], meta)
-    cfdata.append(cfe.cfdata)
-
-cfdata = pd.concat(cfdata).reset_index(drop=True)
-cfdata['conflict'] = cfdata['conflict'].astype(bool)
-cfdata.to_hdf(path_output + 'HundredCar_cfdata.h5', key='data', mode='w')
-print(cfdata.head())
+        merged = self.data_ego.reset_index().merge(self.data_sur.reset_index(), on=['trip_id','time'], suffixes=('_ego', '_sur'))
+        target = merged['trip_id'].map(self.meta['target'])
+        lead = target.str.contains('lead').values
+        follow = ~lead & target.str.contains('follow').values
+
+        # the nearest target per time, forward for lead vehicles and rearward for following vehicles
+        forward = merged['forward'].astype(bool).values
+        candidates = merged[(lead&forward)|(follow&~forward)]
+        nearest = candidates.groupby(['trip_id','time'])['range'].idxmin()
+        nearest = merged.loc[nearest.values, ['trip_id','target_id']]
+        # trips with a single nearest target throughout
+        num_targets = nearest.groupby('trip_id')['target_id'].nunique()
+        single_target = nearest.drop_duplicates('trip_id').set_index('trip_id')['target_id'][num_targets==1]
+        df = merged[merged['target_id'].values==merged['trip_id'].map(single_target).values].copy()
+
+        # focus on the exact moment of conflict, i.e. events up to the tenth-closest range of each trip
+        events = df[df['event'].astype(bool)].sort_values(['trip_id','range'], kind='stable')
+        tenth_range = events[events.groupby('trip_id').cumcount()==10].set_index('trip_id')['range']
+        df.loc[df['range']>df['trip_id'].map(tenth_range), 'event'] = 0
+
+        lead = df['trip_id'].map(self.meta['target']).str.contains('lead').values
+        df['frame_id'] = (df['time']*100).astype(int)
+        df['s'] = np.sqrt((df['x_ego']-df['x_sur'])**2 + (df['y_ego']-df['y_sur'])**2)
+        df['v'] = np.where(lead, df['speed_ego'] - df['speed_sur'], df['speed_sur'] - df['speed_ego'])
+        df['speed'] = np.where(lead, df['speed_ego'], df['speed_sur'])
+
+        # trips in the order they appear in the surrounding data
+        trip_order = pd.Series(np.arange(len(self.trip_ids)), index=self.trip_ids)
+        df = df.iloc[np.argsort(df['trip_id'].map(trip_order).values, kind='stable')]
+        return df[['trip_id','frame_id','s','v','speed','event']].rename(columns={'trip_id':'track_id','event':'conflict'}).reset_index(drop=True)
+
+
+def preprocess(conflict_types=['Crash', 'NearCrash']):
+    # Load data
+    print('Loading data...')
+    cfdata = []
+    for conflict_type in conflict_types:
+        data_ego = pd.read_hdf(path_input + 'HundredCar_'+conflict_type+'_Ego.h5', key='data')
+        data_sur = pd.read_hdf(path_input + 'HundredCar_'+conflict_type+'_Surrounding.h5', key='data')
+        data_sur = data_sur.drop(columns=['x','y'])
+        meta = pd.read_csv(path_input + 'HundredCar_metadata_'+conflict_type+'Event.csv').set_index('webfileid')
+        meta = meta.loc[(data_ego['trip_id'].unique())]
+
+        counted_target = ['lead vehicle','following vehicle']
+        meta = meta[meta['target'].isin(counted_target)] # remain car-following scenarios only
+
+        data_ego = data_ego[data_ego['trip_id'].isin(meta.index)]
+        data_sur = data_sur[data_sur['trip_id'].isin(meta.index)]
+        print(f'There are {data_ego['trip_id'].nunique()} trips for car-following extraction\n')
+
+        # Extract car-following conflict data and save
+        cfe = cf_extractor([data_ego, data_sur], meta)
+        cfdata.append(cfe.cfdata)
+
+    cfdata = pd.concat(cfdata).reset_index(drop=True)
+    cfdata['conflict'] = cfdata['conflict'].astype(bool)
+    # named as Sampling.py and Updating.py read it
+    cfdata.to_hdf(path_output + 'HundredCar_CFData.h5', key='data', mode='w')
+    return cfdata
+
+
+if __name__ == '__main__':
+    cfdata = preprocess()
+    print(cfdata.head())
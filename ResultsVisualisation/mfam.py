@@ -6,6 +6,16 @@ This file is used for once computation for visualisation.
 from tqdm import tqdm
 import numpy as np
 from scipy import stats
+import Caching
+import Computing
+
+# Define the directory of the project, relative to this folder as in IEEE IV.ipynb
+data_path = '../localdata/'
+
+# Define the cache shared with Computing.py
+use_cache = True
+cache_dir = data_path + 'cache/'
+cache_size = 2*1024**3
 
 
 # Define functions
@@ -70,6 +80,12 @@ def spacing_inference(samples_toinfer, roundvs, loc):
 
 
 def solve_threshold(prob_s, prob_sc, smax, c):
+    # curves of the same bin computed by Computing.py with exact gaussian_kde are reused
+    key = Caching.cache_key('curves', [prob_s.dataset[0], prob_sc.dataset[0], [smax, c]], kde_backend='scipy', bw_method='scott')
+    curves = Caching.load_cache(cache_dir, key) if use_cache else None
+    if curves is not None:
+        return curves['range_sc'], curves['pma'], curves['pfa']
+
     range_s = np.arange(0, 200, 0.1)
     density_s = prob_s(range_s)
     smax = max(smax, range_s[np.argmax(density_s)])
@@ -78,13 +94,12 @@ def solve_threshold(prob_s, prob_sc, smax, c):
     cum_smax_sc = prob_sc.integrate_box_1d(0, smax)
 
     range_sc = np.arange(0, smax, 0.1)
-    pma, pfa = [], []
-    for i in range(len(range_sc)):
-        pma0 = prob_sc.integrate_box_1d(range_sc[i], smax)
-        pma.append(pma0)
-        pfa0 = (prob_s.integrate_box_1d(0, range_sc[i])-c*prob_sc.integrate_box_1d(0, range_sc[i]))/(cum_smax_s-c*cum_smax_sc)
-        pfa.append(pfa0)
-    pma = np.array(pma)
-    pfa = np.array(pfa)
+    cdf_s = Computing.kde_cdf(prob_s, range_sc)
+    cdf_sc = Computing.kde_cdf(prob_sc, np.append(range_sc, smax))
+    pma = cdf_sc[-1] - cdf_sc[:-1]
+    pfa = ((cdf_s-cdf_s[0])-c*(cdf_sc[:-1]-cdf_sc[0]))/(cum_smax_s-c*cum_smax_sc)
+
+    if use_cache:
+        Caching.save_cache(cache_dir, key, cache_size, range_sc=range_sc, pma=pma, pfa=pfa, smax=smax, cum_smax_s=cum_smax_s, cum_smax_sc=cum_smax_sc)
 
     return range_sc, pma, pfa